@@ -23,7 +23,11 @@ def argparser():
 	return parser
 
 def init(args):
-	logging.basicConfig(level=args.debug, format='%(levelname)-8s %(message)s')
+	init_logging(args.debug)
+
+# Also used to set up logging in worker processes
+def init_logging(level):
+	logging.basicConfig(level=level, format='%(levelname)-8s %(message)s')
 
 # Used with RawDescriptionTextFormatter
 # Formats multi-line description text nicely (removes indent, wraps lines)
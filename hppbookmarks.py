@@ -93,18 +93,20 @@ def find_event(db, contact, bookmark):
 		pass
 	print "Could not find event directly, looking up by timestamp"
 	# Find the event by timestamp. HPP also selects by CRC but whatever
-	return db.last_event_before_timestamp(contact, bookmark.timestamp+1)
+	return db.last_event_before_timestamp(contact, bookmark.timestamp+1, projection=db.EVENT_BLOB)
 
 
 # Can be called manually for testing
 def main():
 	parser = argparse.ArgumentParser(description="History++ bookmarks for a contact.",	parents=[coreutils.argparser()])
 	parser.add_argument("dbname", help='path to database file')
+	parser.add_argument("--mmap", help='maps the database into memory and decodes it in place (faster with large databases)', action='store_true')
+	parser.add_argument("--index", help='keeps a sidecar index next to the database (dbname.idx) for faster reopening', action='store_true')
 	parser.add_argument('contact', type=str, nargs='*', help='print these contacts (default: all)')
 	args = parser.parse_args()
 	coreutils.init(args)
 	
-	db = mirandadb.MirandaDbxMmap(args.dbname)
+	db = mirandadb.MirandaDbxMmap(args.dbname, use_mmap=args.mmap, use_index=args.index)
 	
 	for contact in mirandadb.select_contacts_opt(db, args.contact):
 		bookmarks = get_bookmarks(db, contact)
@@ -117,6 +119,8 @@ def main():
 				print '[Lost event with timestamp '+str(bookmark.timestamp)+']'
 			else:
 				print mirandadb.format_event(db, event)
+	if args.index:
+		db.update_index()
 
 if __name__ == "__main__":
 	sys.exit(main())
\ No newline at end of file
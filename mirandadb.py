@@ -4,13 +4,24 @@ import argparse
 import logging
 import struct
 import io
+import copy
+import bisect
+from array import array
+import mmap
 import os, codecs, locale
 import coreutils
 import pprint # pretty printing
 import fnmatch # wildcard matching
+import re
+import sqlite3
 import utfutils
 from datetime import datetime # for datetime.now
+from timeit import default_timer
 import calendar
+from collections import Counter
+from itertools import izip, imap, repeat, compress
+import operator
+import multiprocessing
 
 
 # Miranda dbx_mmap database reader
@@ -52,38 +63,82 @@ DBHeader
 #
 class SignatureError(Exception):
 	pass
+
+# Compiled FORMAT/FIELDS/SIGNATURE handling for one DBStruct class.
+# Built once per class on first use (see DBStruct.codec()): caches the struct.Struct and
+# generates unpack/pack functions which assign the fields and check the signature directly,
+# instead of going through hasattr/setattr for every structure read.
+class DBStructCodec(object):
+	def __init__(self, cl):
+		self.name = cl.__name__
+		format = getattr(cl, 'FORMAT', None)
+		self.struct = struct.Struct(format) if format <> None else None
+		self.size = self.struct.size if self.struct <> None else 0
+		if self.struct == None:
+			self.unpack = self.unpack_from = lambda obj, *args: None
+			self.pack = lambda obj: ''
+			return
+		fields = getattr(cl, 'FIELDS', None)
+		signature = getattr(cl, 'SIGNATURE', None)
+		if fields <> None:
+			assert(len(fields)==len(self.struct.unpack('\0'*self.size)))
+			target = '(' + ''.join('self.'+field+', ' for field in fields) + ')'
+			load = '\t' + target + ' = %s\n'
+			store = '\treturn _pack(' + ', '.join('self.'+field for field in fields) + ')\n'
+		else:
+			load = '\tself.unpack(%s)\n'
+			store = '\treturn _pack(*self.pack())\n'
+		check = ''
+		if signature <> None:
+			check = '\tif self.signature <> %d: _bad_signature(self)\n' % signature
+			store = '\tself.signature = %d\n' % signature + store
+		src = ('def unpack(self, buffer):\n' + load % '_unpack(buffer)' + check
+			+ 'def unpack_from(self, buf, offset):\n' + load % '_unpack_from(buf, offset)' + check
+			+ 'def pack(self):\n' + store)
+		namespace = {
+			'_unpack': self.struct.unpack,
+			'_unpack_from': self.struct.unpack_from,
+			'_pack': self.struct.pack,
+			'_bad_signature': self.bad_signature,
+		}
+		exec src in namespace
+		self.unpack = namespace['unpack']				# (obj, buffer)
+		self.unpack_from = namespace['unpack_from']		# (obj, buf, offset)
+		self.pack = namespace['pack']					# (obj) -> bytes
+
+	def bad_signature(self, obj):
+		raise SignatureError(self.name+': expected signature '+str(obj.SIGNATURE)+', found '+str(obj.signature))
+
 class DBStruct(object):
+	__slots__ = ()	# so that DBEventRecord can do without __dict__
+
+	# Returns the DBStructCodec for this class, compiling it on first use
+	@classmethod
+	def codec(cl):
+		codec = cl.__dict__.get('_codec', None)
+		if codec == None:
+			codec = DBStructCodec(cl)
+			cl._codec = codec
+		return codec
+
 	def read(self, file):
 		self.offset = file.tell()	# store offset to help track the origin
-		if hasattr(self, 'FORMAT'):
-			# struct.* only reads from buffer so need to read bytes
-			buffer = file.read(struct.calcsize(self.FORMAT))
-			_tuple = struct.unpack(self.FORMAT, buffer)
-			if hasattr(self, 'FIELDS'):
-				assert(len(_tuple)==len(self.FIELDS))
-				for i in range(0, len(self.FIELDS)):
-					setattr(self, self.FIELDS[i], _tuple[i])
-			else:
-				self.unpack(_tuple)
-		if hasattr(self, 'SIGNATURE'):
-			if self.signature <> self.SIGNATURE:
-				raise SignatureError(type(self).__name__+': expected signature '+str(self.SIGNATURE)+', found '+str(self.signature))
+		codec = self.codec()
+		# struct.* only reads from buffer so need to read bytes
+		codec.unpack(self, file.read(codec.size))
+	# Same as read(), but decodes in place from a buffer-like object (str, mmap, buffer)
+	# without copying it or moving any file pointers. Returns the offset past the static part.
+	def read_from(self, buf, offset):
+		self.offset = offset
+		codec = self.codec()
+		codec.unpack_from(self, buf, offset)
+		return offset + codec.size
 	def write(self, file, offset=None):
 		if offset <> None:
 			file.seek(offset, 0)
-		if hasattr(self, 'SIGNATURE'):
-			self.signature = self.SIGNATURE
-		if hasattr(self, 'FORMAT'):
-			if hasattr(self, 'FIELDS'):
-				_tuple = tuple(getattr(self, field) for field in self.FIELDS)
-			else:
-				_tuple = self.pack()
-			buffer = struct.pack(self.FORMAT, *_tuple)
-			file.write(buffer)
+		file.write(self.codec().pack(self))
 	def size(self):
-		if hasattr(self, 'FORMAT'):
-			return struct.calcsize(self.FORMAT)
-		return 0
+		return self.codec().size
 
 """
 BYTE signature[16];     // 'Miranda ICQ DB',0,26
@@ -130,6 +185,10 @@ class DBModuleName(DBStruct):
 	def read(self, file):
 		super(DBModuleName, self).read(file)
 		self.name = unicode(file.read(self.cbName).decode('ascii'))
+	def read_from(self, buf, offset):
+		offset = super(DBModuleName, self).read_from(buf, offset)
+		self.name = unicode(buf[offset:offset+self.cbName].decode('ascii'))
+		return offset + self.cbName
 	def write(self, file, offset=None):
 		nameBytes = self.name.encode('ascii')
 		self.cbName = len(nameBytes)
@@ -178,12 +237,46 @@ class DBContact(DBStruct):
 			'contactID': self.contactID
 		})
 
-	# Expands some data by seeking and reading it from file:
-	#   Settings (and their module names)
-	settings = None
-	def expand(self, file):
-		if self.settings == None:
+	db = None	# MirandaDbxMmap the contact has been read from, if any
+
+	# Contacts read through MirandaDbxMmap are expanded lazily, on first access to:
+	#   settings		{lowercase moduleName -> DBContactSettings}. Only the headers are read,
+	#					each module's blob is parsed when something in that module is accessed.
+	#   protocol, nick, display_name, uin, id
+	def __getattr__(self, name):
+		if name == 'settings':
+			if self.db == None:
+				raise AttributeError(name)	# call expand(file)
+			self.settings = self.db.read_contact_settings(self)
+		elif name == 'protocol':
+			self.protocol = self.get_setting('Protocol', 'p')
+		elif name == 'nick':
+			self.nick = self.get_setting(self.protocol, 'Nick') if self.protocol <> None else None
+		elif name == 'display_name':
+			# Guess some telling display name
+			display_name = self.get_setting('CList', 'MyHandle')
+			if display_name == None:
+				display_name = self.nick
+			if display_name == None:
+				display_name = u'#'+unicode(self.contactID)
+			if self.protocol <> None:
+				display_name = self.protocol + u'\\' + display_name
+			self.display_name = display_name
+		elif (name == 'uin') or (name == 'id'):
+			if self.db == None:
+				raise AttributeError(name)
+			self.id = self.db.contact_UIN(self)
+			self.uin = self.id
+		else:
+			raise AttributeError(name)
+		return self.__dict__[name]
+
+	# Expands all settings, parsing every module. Without a db, reads them from file.
+	def expand(self, file = None):
+		if (self.db == None) and not ('settings' in self.__dict__):
 			self.settings = self.parse_settings(file)
+		for module in self.settings.values():
+			module.settings()
 		return self.settings
 	
 	# Returns a list of {moduleName -> {settingName -> value}}
@@ -271,7 +364,17 @@ class DBContactSettings(DBStruct):
 		super(DBContactSettings, self).read(file)
 		# blob can be larger that needed so have to read everything ahead
 		self.blob = file.read(self.cbBlob)
-	
+	def read_from(self, buf, offset):
+		offset = super(DBContactSettings, self).read_from(buf, offset)
+		# Only ever parsed from, so a view is enough. A corrupt cbBlob ends it at the end of buf, same as a short read
+		end = min(offset + self.cbBlob, len(buf))
+		self.blob = buffer(buf, offset, max(end - offset, 0))
+		return end
+	def write(self, file, offset=None):
+		self.cbBlob = len(self.blob)
+		super(DBContactSettings, self).write(file, offset)
+		file.write(self.blob)
+
 	moduleName = None
 	def expand(self, file):
 		if self.moduleName == None:
@@ -302,6 +405,20 @@ class DBContactSettings(DBStruct):
 			list[setting.name.lower()] = setting
 		return list
 
+	# Returns [(DBSetting, its bytes in the blob)] in blob order.
+	# The bytes can be copied into another blob as they are, without re-encoding the value.
+	def entries(self):
+		ret = []
+		blobIo = io.BytesIO(self.blob)
+		while blobIo.tell() < len(self.blob):
+			start = blobIo.tell()
+			setting = DBSetting()
+			setting.read(blobIo)
+			if setting.name == None:
+				break
+			ret.append((setting, self.blob[start:blobIo.tell()]))
+		return ret
+
 	def __str__(self):
 		ret = self.moduleName + "\n"
 		settings = self.settings()
@@ -314,11 +431,7 @@ class DBContactSettings(DBStruct):
 		settings = self.settings()
 		if isinstance(arg, (int, long)):
 			return settings[arg]
-		arg = arg.lower()
-		for setting in settings:
-			if setting == arg:
-				return settings[setting]
-		return None
+		return settings.get(arg.lower(), None)
     
 	# Iteration
 	def __iter__(self):
@@ -412,7 +525,7 @@ class DBSetting(DBStruct):
 		self.name = self.name.decode('utf-8')
 		# read the dynamic part
 		if self.type == self.DBVT_DELETED:
-			self.value = Deleted()
+			self.value = self.Deleted()
 		elif self.type == self.DBVT_BYTE:
 			self.value = struct.unpack('B', file.read(1))[0]
 		elif self.type == self.DBVT_WORD:
@@ -472,7 +585,10 @@ WORD  wEventType;       // module-defined event type
 DWORD cbBlob;           // number of bytes in the blob
 BYTE  blob[1];          // the blob. module-defined formatting
 """
-class DBEvent(DBStruct):
+# Common part of DBEvent and DBEventRecord
+class DBEventBase(DBStruct):
+	__slots__ = ()
+
 	# Flags
 	DBEF_SENT		= 2  # this event was sent by the user. If not set this event was received.
 	DBEF_READ		= 4  # event has been read by the user. It does not need to be processed any more except for history.
@@ -586,20 +702,105 @@ class DBEvent(DBStruct):
 		'eventType',
 		'cbBlob'
 	]
+	HEADER_ONLY = False		# read()/write() only the fixed part, see DBEventHeader
+
 	def read(self, file):
-		super(DBEvent, self).read(file)
-		self.blob = file.read(self.cbBlob)
+		super(DBEventBase, self).read(file)
+		if not self.HEADER_ONLY:
+			self.blob = file.read(self.cbBlob)
+	# When reading from a mapped file the blob is kept as a view (blobView) into the mapping,
+	# and is only copied into .blob when someone asks for it.
+	def read_from(self, buf, offset):
+		offset = super(DBEventBase, self).read_from(buf, offset)
+		end = min(offset + self.cbBlob, len(buf))		# a corrupt cbBlob ends at the end of buf, same as a short read
+		if self.HEADER_ONLY:
+			return end
+		try:
+			del self.blob
+		except AttributeError:
+			pass
+		self.blobView = buffer(buf, offset, max(end - offset, 0))
+		return end
+	def __getattr__(self, name):
+		if name == 'blob':
+			self.blob = str(self.blobView)	# AttributeError if there's no view either
+			return self.blob
+		raise AttributeError(name)
+	# Returns the blob without copying it: either .blob or the view into the mapping
+	def blob_view(self):
+		try:
+			return object.__getattribute__(self, 'blob')
+		except AttributeError:
+			return self.blobView
 	def write(self, file):
-		self.cbBlob = len(self.blob)
-		super(DBEvent, self).write(file)
-		file.write(self.blob)
+		if self.HEADER_ONLY:	# only relinking, the blob stays as it is
+			super(DBEventBase, self).write(file)
+			return
+		blob = self.blob_view()
+		self.cbBlob = len(blob)
+		super(DBEventBase, self).write(file)
+		file.write(blob)
 	def size(self):
-		return super(DBEvent, self).size() + len(self.blob)
+		if self.HEADER_ONLY:
+			return super(DBEventBase, self).size() + self.cbBlob
+		return super(DBEventBase, self).size() + len(self.blob_view())
+
+# A regular event: can be extended with any attributes
+class DBEvent(DBEventBase):
+	pass
+
+# Event without the blob: reads and writes only the fixed part
+class DBEventHeader(DBEvent):
+	HEADER_ONLY = True
+
+# Compact event record with fixed attributes and no __dict__, for bulk scans (see EventCursor).
+class DBEventRecord(DBEventBase):
+	__slots__ = DBEventBase.FIELDS + ['offset', 'blob', 'blobView', 'data']
+	# vars() doesn't work on __slots__
+	def __repr__(self):
+		return repr(dict((name, getattr(self, name, None)) for name in self.__slots__))
+
+class DBEventHeaderRecord(DBEventRecord):
+	__slots__ = ()
+	HEADER_ONLY = True
 
 
 #
 # Event content types
 #
+
+# File-like reader over a blob in memory. Blob parsers can look ahead in the buffer
+# instead of reading it byte by byte.
+class BlobCursor(object):
+	def __init__(self, buf):
+		self.buf = buf
+		self.pos = 0
+	def tell(self):
+		return self.pos
+	def seek(self, offset, whence=0):
+		if whence == os.SEEK_CUR:
+			offset += self.pos
+		elif whence == os.SEEK_END:
+			offset += len(self.buf)
+		self.pos = offset
+	def read(self, size=-1):
+		end = len(self.buf) if size < 0 else self.pos + size
+		ret = self.buf[self.pos:end]
+		self.pos += len(ret)
+		return ret
+	# Reads a zero-terminated string. Returns (bytes, terminated) or None if there's nothing left.
+	def read_cstr(self):
+		if self.pos >= len(self.buf):
+			return None
+		end = self.buf.find('\0', self.pos)
+		if end < 0:
+			ret = self.buf[self.pos:]
+			self.pos = len(self.buf)
+			return (ret, False)
+		ret = self.buf[self.pos:end]
+		self.pos = end + 1
+		return (ret, True)
+
 class DBEventBlob(DBStruct):
 	# Omit Unicode if your event type does not care
 	def __init__(self, file = None, unicode = None):
@@ -609,28 +810,37 @@ class DBEventBlob(DBStruct):
 			read_op = getattr(file, "read", None)
 			if not callable(read_op):
 				buf = file
-				file = io.BytesIO(file)
+				file = BlobCursor(file)
 			else:
-				buf = none
+				buf = None
 			self.read(file)
 			pos = file.tell()
 			if buf and not hasattr(self, 'problem') and (len(buf) > pos):
 				self.problem = 'Bytes remaining in the buffer ('+str(pos)+' out of '+str(len(buf))+')'
 				self.tail = buf[pos:]
 	
-	def try_read_str(self, file, default = None):
-		s = ""
+	# Reads a zero-terminated string from a BlobCursor, or any file byte by byte
+	def read_cstr(self, file):
+		if isinstance(file, BlobCursor):
+			return file.read_cstr()
 		c = file.read(1)
 		if len(c) == 0:
-			return default
-		while True:
-			if c == chr(0):
-				break
-			s = s + c
+			return None
+		chars = []
+		while c <> chr(0):
+			chars.append(c)
 			c = file.read(1)
 			if len(c) == 0:
-				self.problem = 'No more bytes where string is expected in event data (read:'+s.encode('hex')+')'
-				break
+				return (''.join(chars), False)
+		return (''.join(chars), True)
+	
+	def try_read_str(self, file, default = None):
+		ret = self.read_cstr(file)
+		if ret == None:
+			return default
+		(s, terminated) = ret
+		if not terminated:
+			self.problem = 'No more bytes where string is expected in event data (read:'+s.encode('hex')+')'
 		if self.unicode:
 			return s.decode('utf-8')
 		else:
@@ -668,12 +878,13 @@ class DBContactsBlob(DBEventBlob):
 	#   MRA\src\MraProto.cpp\RecvContacts()
 	#   src\skype_proto.cpp\RecvContacts()
 	def read(self, file):
-		super(DBURLBlob, self).read(file)
+		super(DBContactsBlob, self).read(file)
 		self.contacts = []
 		while True:
 			nick = self.try_read_str(file)
-			if nick <> None:
-				address = self.read_str(file)
+			if nick == None:
+				break
+			address = self.read_str(file)
 			self.contacts.append((nick, address))
 
 class DBAuthBlob(DBEventBlob):
@@ -812,34 +1023,297 @@ class DBVKontakteUserDeactivateActionBlob(DBEventBlob):
 		self.description = self.read_str(file)
 
 
+#
+# Event decoders
+# Each decoder turns an event blob into an object that can be vars()ed: decode(db, event, unicode) -> data
+# Decoders are looked up by (base protocol, eventType), then by eventType alone.
+#
+class EventDecoder(object):
+	def __init__(self, name, decode):
+		self.name = name
+		self.decode = decode
+		self.calls = 0
+		self.failures = 0	# exceptions or results with a problem
+		self.time = 0.0		# seconds spent
+	def __call__(self, db, event, _unicode):
+		self.calls += 1
+		start = default_timer()
+		try:
+			ret = self.decode(db, event, _unicode)
+		except:
+			self.failures += 1
+			raise
+		finally:
+			self.time += default_timer() - start
+		if hasattr(ret, 'problem'):
+			self.failures += 1
+		return ret
+
+_typeDecoders = {}		# eventType -> EventDecoder
+_protoDecoders = {}		# eventType -> {base protocol -> EventDecoder}
+
+# Registers a decoder for the event type, for all protocols or only for the given base protocol.
+#   decoder: DBEventBlob subclass, constructed as (blob, unicode), or decode(db, event, unicode)
+#   pass_unicode: False to construct the blob class with unicode=None (it's not for the event flags to tell)
+# Returns the EventDecoder that keeps the counters.
+def register_decoder(eventType, decoder, proto=None, pass_unicode=True, name=None):
+	if isinstance(decoder, type) and issubclass(decoder, DBEventBlob):
+		if name == None:
+			name = decoder.__name__
+		if pass_unicode:
+			decoder = (lambda cl: lambda db, event, _unicode: cl(event.blob, _unicode))(decoder)
+		else:
+			decoder = (lambda cl: lambda db, event, _unicode: cl(event.blob))(decoder)
+	decoder = EventDecoder(name or decoder.__name__, decoder)
+	if proto == None:
+		_typeDecoders[eventType] = decoder
+	else:
+		_protoDecoders.setdefault(eventType, {})[proto] = decoder
+	return decoder
+
+# Returns all EventDecoders, including those for encrypted and unsupported events
+def get_decoders():
+	ret = [_encryptedDecoder, _unsupportedDecoder] + _typeDecoders.values()
+	for decoders in _protoDecoders.values():
+		ret += decoders.values()
+	return ret
+
+def decode_string(db, event, _unicode):
+	return db.decode_event_data_string(event, _unicode)
+
+def decode_hex(type):
+	return lambda db, event, _unicode: MessageBlob(
+		type = type,
+		hex = event.blob.encode('hex'),
+		unicode = _unicode
+	)
+
+_encryptedDecoder = EventDecoder('encrypted', decode_hex('encrypted'))		# Can't decrypt, return hex
+_unsupportedDecoder = EventDecoder('unsupported', decode_hex('unsupported'))
+
+register_decoder(DBEventBase.EVENTTYPE_MESSAGE, decode_string, name='message')
+register_decoder(DBEventBase.EVENTTYPE_URL, DBURLBlob)
+register_decoder(DBEventBase.EVENTTYPE_CONTACTS, DBContactsBlob)
+register_decoder(DBEventBase.EVENTTYPE_ADDED, DBAuthBlob)
+register_decoder(DBEventBase.EVENTTYPE_AUTHREQUEST, DBAuthRequestBlob)
+register_decoder(DBEventBase.EVENTTYPE_FILE, DBFileBlob)
+# Both NewXStatusNotify and TabSRMM produce this as UTF8 DBEF_UTF
+# The text is freeform and expects adding nickname at the beginning:
+#	"signed off."
+#	"signed on and is now %s."
+#	"changed status from %s to %s."
+register_decoder(DBEventBase.EVENTTYPE_STATUSCHANGE, decode_string, name='statuschange')
+register_decoder(DBEventBase.EVENTTYPE_AVATAR_CHANGE, DBAvatarChangeBlob)
+register_decoder(DBEventBase.ICQEVENTTYPE_MISSEDMESSAGE, DBICQMissedMessageBlob, proto='ICQ', pass_unicode=False)
+register_decoder(DBEventBase.ICQEVENTTYPE_SMS, DBICQSMSBlob, proto='ICQ', pass_unicode=False)
+register_decoder(DBEventBase.ICQEVENTTYPE_SMSCONFIRMATION, DBICQSMSConfirmationBlob, proto='ICQ', pass_unicode=False)
+register_decoder(DBEventBase.ICQEVENTTYPE_WEBPAGER, DBICQWebPagerBlob, proto='ICQ', pass_unicode=False)
+register_decoder(DBEventBase.ICQEVENTTYPE_EMAILEXPRESS, DBICQEmailExpressBlob, proto='ICQ', pass_unicode=False)
+register_decoder(DBEventBase.EVENTTYPE_JABBER_PRESENCE, DBJabberPresenceBlob, proto='JABBER', pass_unicode=False)
+register_decoder(DBEventBase.EVENTTYPE_JABBER_CHATSTATES, DBJabberChatStatesBlob, proto='JABBER', pass_unicode=False)
+register_decoder(DBEventBase.VK_USER_DEACTIVATE_ACTION, DBVKontakteUserDeactivateActionBlob, proto='VKontakte', pass_unicode=False)
+
+
+"""
+Sidecar index file (<dbname>.idx), see MirandaDbxMmap.load_index().
+Not a part of the database, so native byte order and sizes:
+DBIndexHeader
+DWORD moduleCount;	then (DWORD offset, DBModuleName) for each module in chain order
+DWORD contactCount;	then (DWORD offset, DBContact) for each contact in chain order, excluding the user
+DWORD settingsCount;	then (DWORD contact offset, DWORD count, DWORD[count] ofsSettings) for each contact, including the user
+DWORD chainCount;	then (DWORD contactID, DWORD sorted, DWORD count, DWORD[count] timestamps, offsets, contactIDs)
+					for each hosting contact, see MirandaDbxMmap.EventIndex
+"""
+class DBIndexHeader(DBStruct):
+	MAGIC = 'MDBXIDX\0'
+	VERSION = 1
+	FORMAT = '=8sIQd32s'
+	FIELDS = [
+		'magic',
+		'version',
+		'fileSize',		# of the database file when the index was saved
+		'mtime',
+		'dbHeader'		# DBHeader, as stored (ofsFileEnd, slackSpace, contactCount and so on)
+	]
+	COUNT = struct.Struct('=I')
+
+
 class MirandaDbxMmap(object):
 	file = None
-	def __init__(self, filename, writeable=False):
+	mm = None	# the whole file mapped to memory, if use_mmap
+	mmPos = 0	# where the last read from mm ended, as the file pointer would be
+	modified = False	# set on any write
+	#   use_mmap: map the file and decode all structures in place, without read() calls
+	#   use_index: load the sidecar index if it's valid, see load_index()
+	def __init__(self, filename, writeable=False, use_mmap=False, use_index=False):
 		self._baseProtocols = {}
 		self._moduleNames = {}
+		self._settingsOffsets = {}
 		self._eventChains = {}
+		self._eventIndexes = {}
 		open_mode = "rb+" if writeable else "rb"
 		self.file = open(filename, open_mode)
 		self.filename = filename
+		if use_mmap:
+			self.remap()
 		self.header = self.read(DBHeader())
-		self.user = self.read(DBContact(), self.header.ofsUser)
-		self.expand_contact(self.user)
+		self.user = self.read_contact(self.header.ofsUser)
+		if use_index:
+			self.load_index()
+
+	# (Re)maps the file. Writes still go through the file, and the mapping has to be refreshed
+	# once the file grows. Older mappings stay alive for as long as someone holds views into them.
+	def remap(self):
+		self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
 
 	# Reads and unpacks data at a given offset or where the pointer is now
 	# cl must provide cl.FORMAT and cl.unpack()
 	def read(self, cl, offset = None):
-		if offset <> None:
-			self.file.seek(offset, 0)
-		cl.read(self.file)
-		log.debug(vars(cl))
+		if self.batch_writes <> None:
+			# Some of the data may not be in the file yet, read through the pending writes
+			if offset <> None:
+				self.batch_writes.seek(offset)
+			cl.read(self.batch_writes)
+		elif self.mm <> None:
+			if offset == None:
+				offset = self.mmPos
+			self.mmPos = cl.read_from(self.mm, offset)
+		else:
+			if offset <> None:
+				self.file.seek(offset, 0)
+			cl.read(self.file)
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug(vars(cl) if hasattr(cl, '__dict__') else cl)
 		return cl
-	
+
 	# By default we write at the offset specified in the structure
 	def write(self, cl, offset):
-		log.debug('Writing at offset '+str(offset)+': '+str(vars(cl)))
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug('Writing at offset '+str(offset)+': '+str(vars(cl) if hasattr(cl, '__dict__') else cl))
+		if self.batch_writes <> None:
+			data = io.BytesIO()
+			cl.write(data)
+			self.batch_writes.add(offset, data.getvalue())
+			self.modified = True
+			return
 		self.file.seek(offset, 0)
 		cl.write(self.file)
-	
+		self.modified = True
+		if self.mm <> None:
+			self.file.flush()		# so that the mapping sees it
+			if self.file.tell() > len(self.mm):
+				self.remap()
+
+	# Write batching. Within
+	#   with db.batch():
+	#       ...
+	# all write()s are kept in memory, coalescing repeated writes of the same header, contact or event,
+	# and then go to the file at once, in offset order, when the outermost batch ends.
+	# Reads see the pending writes. Leaving the batch on an exception still writes everything,
+	# same as if there was no batching (the cached structures have been changed already).
+	batch_writes = None		# the active WriteBatch
+	def batch(self):
+		if self.batch_writes <> None:
+			return self.batch_writes		# nested batches are a part of the outer one
+		return self.WriteBatch(self)
+
+	class WriteBatch:
+		def __init__(self, db):
+			self.db = db
+			self.depth = 0
+			self.offsets = []	# sorted offsets of pending chunks
+			self.chunks = {}	# offset -> bytes. Chunks never overlap, overlapping writes are merged
+			self.pos = 0		# file pointer for reads
+		def __enter__(self):
+			self.db.batch_writes = self
+			self.depth += 1
+			return self
+		def __exit__(self, type, value, traceback):
+			self.depth -= 1
+			if self.depth == 0:
+				self.db.batch_writes = None
+				self.commit()
+			return False
+
+		# Returns the index of the first chunk which ends after the offset
+		def chunk_at(self, offset):
+			i = bisect.bisect_right(self.offsets, offset)
+			if (i > 0) and (self.offsets[i-1] + len(self.chunks[self.offsets[i-1]]) > offset):
+				i -= 1
+			return i
+
+		def add(self, offset, data):
+			if len(data) <= 0:
+				return
+			end = offset + len(data)
+			i = self.chunk_at(offset)
+			j = i
+			while (j < len(self.offsets)) and (self.offsets[j] < end):
+				j += 1
+			if j > i:
+				# Merge with the chunks we overlap, newer data on top
+				start = min(self.offsets[i], offset)
+				last = self.offsets[j-1]
+				merged = bytearray(max(last + len(self.chunks[last]), end) - start)
+				for ofs in self.offsets[i:j]:
+					chunk = self.chunks.pop(ofs)
+					merged[ofs-start:ofs-start+len(chunk)] = chunk
+				merged[offset-start:end-start] = data
+				del self.offsets[i:j]
+				(offset, data) = (start, str(merged))
+			self.offsets.insert(i, offset)
+			self.chunks[offset] = data
+
+		# File-like interface for DBStruct.read()
+		def seek(self, offset, whence=0):
+			self.pos = offset
+		def tell(self):
+			return self.pos
+		def read(self, size):
+			file = self.db.file
+			file.seek(self.pos, 0)
+			data = file.read(size)
+			end = self.pos + size
+			i = self.chunk_at(self.pos)
+			if (i < len(self.offsets)) and (self.offsets[i] < end):
+				# Pending data can go past the end of the file
+				last = self.offsets[i]
+				while (i+1 < len(self.offsets)) and (self.offsets[i+1] < end):
+					i += 1
+					last = self.offsets[i]
+				data = bytearray(data.ljust(min(end, last + len(self.chunks[last])) - self.pos, '\0'))
+				for ofs in self.offsets[self.chunk_at(self.pos):i+1]:
+					chunk = self.chunks[ofs]
+					lo = max(ofs, self.pos)
+					hi = min(ofs + len(chunk), end)
+					data[lo-self.pos:hi-self.pos] = chunk[lo-ofs:hi-ofs]
+				data = str(data)
+			self.pos += len(data)
+			return data
+
+		# Writes all pending chunks, adjacent ones together
+		def commit(self):
+			file = self.db.file
+			i = 0
+			while i < len(self.offsets):
+				start = self.offsets[i]
+				parts = [self.chunks[start]]
+				end = start + len(parts[0])
+				i += 1
+				while (i < len(self.offsets)) and (self.offsets[i] == end):
+					parts.append(self.chunks[end])
+					end += len(parts[-1])
+					i += 1
+				file.seek(start, 0)
+				file.write(''.join(parts))
+			self.offsets = []
+			self.chunks = {}
+			if self.db.mm <> None:
+				file.flush()
+				file.seek(0, os.SEEK_END)
+				if file.tell() > len(self.db.mm):
+					self.db.remap()
+
 	
 	# Reserves space of a given size at the end of the file. Returns its offset
 	def reserve_space(self, size):
@@ -852,18 +1326,21 @@ class MirandaDbxMmap(object):
 		if fsize < self.header.ofsFileEnd:
 			self.file.seek(self.header.ofsFileEnd+4096)
 			self.file.write('\0')
+			if self.mm <> None:
+				self.file.flush()
+				self.remap()
 		self.write(self.header, 0)
 		return offset
 	# Reallocates space of a given size, possibly inplace. Returns its new offset
 	def realloc_space(self, offset, old_size, new_size):
 		if old_size >= new_size:
 			if old_size > new_size:
-				self.header.slackSpace += (new_size-old_size)
+				self.header.slackSpace += (old_size-new_size)
 				self.write(self.header, offset=0)
 			return offset
 		self.header.slackSpace += old_size
 		# ^ do not commit, we'll write more in a moment
-		return reserve_space(new_size)
+		return self.reserve_space(new_size)
 	# Releases a chunk of space
 	def free_space(self, offset, size):
 		self.header.slackSpace += size
@@ -878,28 +1355,34 @@ class MirandaDbxMmap(object):
 	# Cached module list
 	# All reads and writes to modules must go through cache-aware function
 	_modules = None
+	_modulesByOffset = None		# offset -> DBModuleName
+	_moduleOffsets = None		# lowercase name -> offset of the first module with that name
 	def get_modules(self):
 		if self._modules == None:
 			self._modules = []
+			self._modulesByOffset = {}
+			self._moduleOffsets = {}
 			moduleOffset = self.header.ofsModuleNames
 			while moduleOffset <> 0:
 				module = self.read(DBModuleName(), moduleOffset)
-				self._modules.append(module)
+				self.module_cache_add(module)
 				moduleOffset = module.ofsNext
 		return self._modules
+	def module_cache_add(self, module):
+		self._modules.append(module)
+		self._modulesByOffset[module.offset] = module
+		self._moduleOffsets.setdefault(module.name.lower(), module.offset)
 	def get_module(self, offset):
-		for module in self.get_modules():
-			if module.offset == offset:
-				return module
-		return None
+		if self._modulesByOffset == None:
+			self.get_modules()
+		return self._modulesByOffset.get(offset, None)
 	def get_module_name(self, ofsModule):
 		module = self.get_module(ofsModule)
 		return module.name if module else None
 	def find_module_name(self, name):
-		for module in self.get_modules():
-			if module.name.lower() == name.lower():
-				return module.offset
-		return None
+		if self._moduleOffsets == None:
+			self.get_modules()
+		return self._moduleOffsets.get(name.lower(), None)
 
 	# For modules that are accounts, returns their base protocol (string)
 	_baseProtocols = None
@@ -931,53 +1414,170 @@ class MirandaDbxMmap(object):
 				offset = lastModuleName.ofsNext
 			lastModuleName.ofsNext = moduleName.offset
 			self.write(lastModuleName, lastModuleName.offset)
+		if self._modules <> None:
+			self.module_cache_add(moduleName)
+		return moduleName.offset
 
 	#
 	# Contacts
 	#
 	
+	# Reads the contact header. Everything else is read on demand, see DBContact
 	def read_contact(self, offset):
-		return self.read(DBContact(), offset)
+		contact = self.read(DBContact(), offset)
+		contact.db = self
+		return contact
 	
 	# Returns a list of all DBContact()s
 	_contacts = None
+	_contactsById = None		# contactID -> DBContact, including the user
+	_contactsByUin = None		# (lowercase protocol, UIN) -> DBContact
+	_contactsByOffset = None	# offset -> DBContact, including the user
 	def contacts(self):
 		if self._contacts == None:
 			self._contacts = []
 			contactOffset = self.header.ofsFirstContact
 			while contactOffset <> 0:
-				contact = self.read(DBContact(), contactOffset)
+				contact = self.read_contact(contactOffset)
 				self._contacts.append(contact)
 				contactOffset = contact.ofsNext
-			for contact in self._contacts:
-				self.expand_contact(contact)
+			self.contact_cache_rebuild()
 		return self._contacts
+
+	# Rebuilds contact indexes. Call if you add, remove or change the ID/protocol/UIN of the contacts.
+	def contact_cache_rebuild(self):
+		self._contactsById = {}
+		for contact in [self.user] + self._contacts:
+			self._contactsById.setdefault(contact.contactID, contact)
+		self._contactsByOffset = dict((contact.offset, contact) for contact in [self.user] + self._contacts)
+		self._contactsByUin = None		# requires parsing settings so built on demand
+
+	def contact_uin_cache_rebuild(self):
+		self._contactsByUin = {}
+		for contact in [self.user] + self.contacts():
+			if (contact.protocol <> None) and (contact.uin <> None):
+				self._contactsByUin.setdefault((contact.protocol.lower(), contact.uin), contact)
 	
-	def expand_contact(self, contact):
-		contact.expand(self.file)
-		contact.protocol = contact.get_setting('Protocol', 'p')
-		if contact.protocol <> None:
-			contact.nick = contact.get_setting(contact.protocol, 'Nick')
+	# Reads the settings chain headers for the contact: {lowercase moduleName -> DBContactSettings}
+	# Blobs are parsed on demand.
+	_settingsOffsets = None		# contact offset -> array of its DBContactSettings offsets, in chain order
+	def read_contact_settings(self, contact):
+		list = {}
+		offsets = self._settingsOffsets.get(contact.offset, None)
+		if offsets == None:
+			offsets = array('I')
+			ofsSettings = contact.ofsFirstSettings
+			while ofsSettings > 0:
+				offsets.append(ofsSettings)
+				settings = self.read_settings_header(ofsSettings)
+				list[settings.moduleName.lower()] = settings
+				ofsSettings = settings.ofsNext
+			self._settingsOffsets[contact.offset] = offsets
+			return list
+		for ofsSettings in offsets:
+			settings = self.read_settings_header(ofsSettings)
+			list[settings.moduleName.lower()] = settings
+		return list
+
+	# Returns the offsets of the contact's DBContactSettings, in chain order
+	def contact_settings_offsets(self, contact):
+		if not contact.offset in self._settingsOffsets:
+			self.read_contact_settings(contact)
+		return self._settingsOffsets[contact.offset]
+
+	def read_settings_header(self, offset):
+		settings = self.read(DBContactSettings(), offset)
+		settings.moduleName = self.get_module_name(settings.ofsModuleName)
+		if settings.moduleName == None:		# not in the module chain, but may still be there
+			settings.moduleName = self.read_module(settings.ofsModuleName).name
+		return settings
+
+	# Miranda grows settings blobs in steps of this size so that adding a setting rarely moves them
+	SETTINGS_RESIZE_GRANULARITY = 128
+	def pad_settings_blob(self, blob):
+		blob += '\0'	# cbName == 0 terminates the chain
+		return blob + '\0' * (-len(blob) % self.SETTINGS_RESIZE_GRANULARITY)
+
+	# Replaces the contents of the contact's module settings (as read by read_settings_header())
+	# with the given back-to-back DBSettings. Moves them to the end of the file if they don't fit.
+	def write_contact_settings(self, contact, settings, blob):
+		# Requery the link! Moving another module of this contact could've changed it
+		settings.ofsNext = self.read_settings_header(settings.offset).ofsNext
+		if len(blob) < settings.cbBlob:		# room for the terminator
+			settings.blob = blob + '\0' * (settings.cbBlob - len(blob))
+			self.write(settings, settings.offset)
+			self.contact_settings_changed(contact)
+			return settings.offset
+		offsets = self.contact_settings_offsets(contact)
+		i = offsets.index(settings.offset)
+		old_size = settings.size() + settings.cbBlob		# size() is only the fixed part
+		settings.blob = self.pad_settings_blob(blob)
+		settings.offset = self.realloc_space(settings.offset, old_size, settings.size() + len(settings.blob))
+		self.write(settings, settings.offset)
+		# Relink
+		if i == 0:
+			contact.ofsFirstSettings = settings.offset
+			self.write(contact, contact.offset)
 		else:
-			contact.nick = None
-		# Guess some telling display name
-		contact.display_name = contact.get_setting('CList', 'MyHandle')
-		if contact.display_name == None:
-			contact.display_name = contact.nick
-		if contact.display_name == None:
-			contact.display_name = u'#'+unicode(contact.contactID);
-		if contact.protocol <> None:
-			contact.display_name = contact.protocol + u'\\' + contact.display_name
-		contact.uin = self.contact_UIN(contact)
+			prev = self.read_settings_header(offsets[i-1])
+			prev.ofsNext = settings.offset
+			self.write(prev, prev.offset)
+		self.contact_settings_changed(contact)
+		return settings.offset
+
+	# Adds settings for another module to the contact, blob as above. Returns their offset
+	def add_contact_settings(self, contact, ofsModuleName, blob):
+		settings = DBContactSettings()
+		settings.ofsNext = contact.ofsFirstSettings
+		settings.ofsModuleName = ofsModuleName
+		settings.blob = self.pad_settings_blob(blob)
+		settings.offset = self.reserve_space(settings.size() + len(settings.blob))
+		self.write(settings, settings.offset)
+		# Miranda links new modules at the start of the chain
+		contact.ofsFirstSettings = settings.offset
+		self.write(contact, contact.offset)
+		self.contact_settings_changed(contact)
+		return settings.offset
+
+	# All settings writes must end with this: drops everything that has been cached from the old settings
+	def contact_settings_changed(self, contact):
+		self._settingsOffsets.pop(contact.offset, None)
+		for cached in [contact, self.contact_by_offset(contact.offset)]:
+			cached.ofsFirstSettings = contact.ofsFirstSettings
+			for name in ['settings', 'protocol', 'nick', 'display_name', 'uin', 'id']:
+				cached.__dict__.pop(name, None)
+		self._contactsByUin = None
+		if contact.offset == self.user.offset:
+			self._baseProtocols = {}
+
+	# Contacts are expanded lazily, this forces full expansion (all settings parsed, all names computed)
+	def expand_contact(self, contact):
+		if contact.db == None:
+			contact.db = self
+		contact.expand()
+		contact.display_name
+		contact.uin
 	
 	# Returns a contact by its database contactID
 	def contact_by_id(self, id):
 		if id == 0:
 			return self.user
-		for contact in self.contacts():
-			if contact.contactID == id:
-				return contact
-		return None
+		if self._contactsById == None:
+			self.contacts()
+		return self._contactsById.get(id, None)
+
+	# Returns a contact by its offset, cached if it's in the contact chain
+	def contact_by_offset(self, offset):
+		if self._contactsByOffset == None:
+			self.contacts()
+		contact = self._contactsByOffset.get(offset, None)
+		return contact if contact <> None else self.read_contact(offset)
+
+	# Returns a contact by its protocol (module name) and protocol-dependent UIN
+	def contact_by_uin(self, protocol, uin):
+		if self._contactsByUin == None:
+			self.contact_uin_cache_rebuild()
+		return self._contactsByUin.get((protocol.lower(), uin), None)
 	
 	# Returns the meta contact for the given contact, or None
 	def get_meta_contact(self, contact):
@@ -1032,6 +1632,7 @@ class MirandaDbxMmap(object):
 			contact.id = contact.get_setting(contact.protocol, "uin")	# ICQ
 		if contact.id == None:
 			contact.id = contact.get_setting(contact.protocol, "id")	# vkontakte
+		return contact.id
 
 	# Returns the "uri:UIN" scheme URI for the contact
 	#   contact: DBContact() or any sort of proto-specific UIN
@@ -1065,8 +1666,22 @@ class MirandaDbxMmap(object):
 	#
 	# Events
 	#
-	def read_event(self, offset):
-		return self.read(DBEvent(), offset)
+
+	# Event projections: what to read for each event
+	EVENT_HEADER = 0	# only the fixed part (DBEventHeader)
+	EVENT_BLOB = 1		# the fixed part and the raw blob
+	EVENT_DECODED = 2	# the blob, decoded into .data
+
+	def read_event(self, offset, projection=EVENT_BLOB):
+		if projection == self.EVENT_HEADER:
+			return self.read(DBEventHeader(), offset)
+		event = self.read(DBEvent(), offset)
+		if projection == self.EVENT_DECODED:
+			event.data = self.decode_event_data(event)
+		return event
+
+	def read_event_header(self, offset):
+		return self.read(DBEventHeader(), offset)
 	
 	# Adds a new event to the database. Returns new event offset.
 	#	contact: Determined automatically, minding metacontacts.
@@ -1081,23 +1696,25 @@ class MirandaDbxMmap(object):
 			contact = self.get_host_contact(event.contactID)
 		# Select insert_after
 		if insert_after == None:
-			insert_after = self.last_event_before_timestamp(contact, event.timestamp+1)
+			# After the last event in the chain with timestamp <= ours, whoever it belongs to
+			ofsAfter = self.get_event_index(contact).last_before(event.timestamp+1)
+			insert_after = self.read_event_header(ofsAfter) if ofsAfter <> 0 else None
 		elif insert_after == 0:
 			insert_after = None
 		elif insert_after < 0:
-			insert_after = self.db.get_last_event(contact)
+			insert_after = self.get_last_event(contact)
 		else:
 			# Requery the event! The prev/next in this one can be stale
-			insert_after = self.read_event(insert_after.offset)
-		# Link events together
+			insert_after = self.read_event_header(insert_after.offset)
+		# Link events together (neighbours are only relinked, so headers are enough)
 		if insert_after == None:
 			if contact.ofsFirstEvent <> 0:
-				evtNext = self.read_event(contact.ofsFirstEvent)
+				evtNext = self.read_event_header(contact.ofsFirstEvent)
 			else:
 				evtNext = None
 			contact.ofsFirstEvent = event.offset
 		elif insert_after.ofsNext <> 0:
-			evtNext = self.read_event(insert_after.ofsNext)
+			evtNext = self.read_event_header(insert_after.ofsNext)
 		else:
 			evtNext = None
 			contact.ofsLastEvent = event.offset
@@ -1119,19 +1736,104 @@ class MirandaDbxMmap(object):
 			child_contact.eventCount += 1
 			self.write(child_contact, child_contact.offset)
 		self.event_cache_invalidate(contact.contactID)
+		index = self._eventIndexes.get(contact.contactID, None)
+		if index <> None:
+			index.insert_after(insert_after, event)
 		return event.offset
+
+	# Adds many events to one chain at once. Returns their new offsets.
+	# Each event goes where add_event() would've put it: after the last event with timestamp <= its own,
+	# including events added before it. Sort the events by timestamp for this to be a single merge pass.
+	# New events are stored together at the end of the file and every affected pointer is written once.
+	#	contact: The host contact for all of the events. Determined from the first event by default.
+	def add_events(self, events, contact=None):
+		if len(events) <= 0:
+			return []
+		with self.batch():
+			offset = self.reserve_space(sum(event.size() for event in events))
+			for event in events:
+				event.offset = offset
+				offset += event.size()
+			self.link_events(events, contact)
+		return [event.offset for event in events]
+
+	# Links events which are already stored in the file (have offsets) into the chain, the same way
+	# as add_events() does. Writes each event with write(), so pass DBEventHeaders to only relink them.
+	def link_events(self, events, contact=None):
+		if len(events) <= 0:
+			return
+		if contact == None:
+			contact = self.get_host_contact(events[0].contactID)
+		index = self.get_event_index(contact)
+		# Positions in the existing chain to insert after (-1: at the start)
+		positions = []
+		pos = -1
+		lastTimestamp = 0
+		for event in events:
+			if index.sorted and (event.timestamp >= lastTimestamp):
+				while (pos+1 < len(index)) and (index.timestamps[pos+1] <= event.timestamp):
+					pos += 1
+			else:
+				pos = index.position_before(event.timestamp+1)
+			positions.append(pos)
+			lastTimestamp = event.timestamp
+		# Runs of new events going after the same existing one. Within a run, each add_event() would've
+		# gone after the earlier ones with timestamp <= its own, which is what a stable sort gives.
+		runs = {}
+		for (event, pos) in zip(events, positions):
+			runs.setdefault(pos, []).append(event)
+		for run in runs.values():
+			run.sort(key=lambda event: event.timestamp)
+		with self.batch():
+			neighbours = {}		# offset -> DBEventHeader, each one is written once
+			def neighbour(pos):
+				offset = index.offsets[pos]
+				if not offset in neighbours:
+					neighbours[offset] = self.read_event_header(offset)
+				return neighbours[offset]
+			for (pos, run) in runs.items():
+				ofsPrev = index.offsets[pos] if pos >= 0 else 0
+				ofsNext = index.offsets[pos+1] if pos+1 < len(index) else 0
+				for i in xrange(len(run)):
+					run[i].ofsPrev = run[i-1].offset if i > 0 else ofsPrev
+					run[i].ofsNext = run[i+1].offset if i+1 < len(run) else ofsNext
+				if ofsPrev <> 0:
+					neighbour(pos).ofsNext = run[0].offset
+				else:
+					contact.ofsFirstEvent = run[0].offset
+				if ofsNext <> 0:
+					neighbour(pos+1).ofsPrev = run[-1].offset
+				else:
+					contact.ofsLastEvent = run[-1].offset
+			for event in events:
+				self.write(event, event.offset)
+			for evtNeighbour in neighbours.values():
+				self.write(evtNeighbour, evtNeighbour.offset)
+			# When updating metacontacts, we must update both the host and the children
+			contact.eventCount += len(events)
+			self.write(contact, contact.offset)
+			childCounts = {}
+			for event in events:
+				if event.contactID <> contact.contactID:
+					childCounts[event.contactID] = childCounts.get(event.contactID, 0) + 1
+			for (contactId, count) in childCounts.items():
+				child_contact = self.contact_by_id(contactId)
+				child_contact.eventCount += count
+				self.write(child_contact, child_contact.offset)
+		self.event_cache_invalidate(contact.contactID)
+		index.splice(runs)
 	
 	# Deletes event from the given contact, linking events around it together
 	def delete_event(self, offset, contact=None):
 		# We must use base offsets only, clients will often have stale ofsPrev/ofsNext pointers,
 		# especially when doing mass deletions.
-		if isinstance(offset, DBEvent):
+		if isinstance(offset, DBEventBase):
 			offset = offset.offset
 		log.debug('Deleting event '+str(offset)+'...')
 		# To trust DBEvent() fields we must have some kind of "single-instance events":
 		# cache returned DBEvents and update on the fly, removing only on __del__.
 		# And that might not be wise. What if someone's iterating over them? Safer to just requery on each edit.
-		event = self.read_event(offset)
+		event = self.read_event_header(offset)
 		if contact == None:
 			contact = self.get_host_contact(event.contactID)
 			# The event can IN FACT be hosted elsewhere, for whatever reason.
@@ -1143,13 +1845,13 @@ class MirandaDbxMmap(object):
 			contact.ofsFirstEvent = ofsNext
 			# Do not write out, will modify more
 		else:
-			evtPrev = self.read_event(ofsPrev)
+			evtPrev = self.read_event_header(ofsPrev)
 			evtPrev.ofsNext = ofsNext
 			self.write(evtPrev, evtPrev.offset)	# The size shouldn't have changed
 		if ofsNext == 0:
-			contact.ofsNextEvent = ofsPrev
+			contact.ofsLastEvent = ofsPrev
 		else:
-			evtNext = self.read_event(ofsNext)
+			evtNext = self.read_event_header(ofsNext)
 			evtNext.ofsPrev = ofsPrev
 			self.write(evtNext, evtNext.offset)	# The size shouldn't have changed
 		contact.eventCount -= 1
@@ -1161,6 +1863,9 @@ class MirandaDbxMmap(object):
 			self.write(child_contact, child_contact.offset)
 		self.free_space(event.offset, event.size())
 		self.event_cache_invalidate(contact.contactID)
+		index = self._eventIndexes.get(contact.contactID, None)
+		if (index <> None) and not index.remove(event):
+			del self._eventIndexes[contact.contactID]	# wasn't there, so the index is not to be trusted
 	
 	# MetaContacts steal events from their children but leave contactId and moduleName intact:
 	#    Contact1: 4 events, first: None
@@ -1175,18 +1880,218 @@ class MirandaDbxMmap(object):
 	def event_cache_invalidate(self, contactId):
 		if contactId in self._eventChains:
 			del self._eventChains[contactId]
+
+	# Timestamp index of all events hosted by a contact, in chain order.
+	# Built from headers in one pass, kept up to date by add_event()/delete_event().
+	# Chains are normally sorted by timestamp, and then lookups are bisections.
+	# For the rare unsorted chains we scan the index (still in memory) the same way get_events() would.
+	class EventIndex:
+		#   contact: None to create an empty index (to be filled by the caller)
+		def __init__(self, db, contact):
+			self.timestamps = array('I')
+			self.offsets = array('I')
+			self.contactIDs = array('I')
+			self.sorted = True
+			if contact == None:
+				return
+			lastTimestamp = 0
+			for event in db.scan_events(contact, header_only=True):
+				self.timestamps.append(event.timestamp)
+				self.offsets.append(event.offset)
+				self.contactIDs.append(event.contactID)
+				if event.timestamp < lastTimestamp:
+					self.sorted = False
+				lastTimestamp = event.timestamp
+		def __len__(self):
+			return len(self.offsets)
+
+		# Returns the chain in EventIter format: [(offset, contactId), ..., (0,0)]
+		def chain(self):
+			return zip(self.offsets, self.contactIDs) + [(0,0)]
+
+		# Returns the position of the last event with timestamp < given, or -1
+		#   contactId: only consider events belonging to this contact
+		def position_before(self, timestamp, contactId=None):
+			if self.sorted:
+				pos = bisect.bisect_left(self.timestamps, timestamp) - 1
+				if contactId <> None:
+					while (pos >= 0) and (self.contactIDs[pos] <> contactId):
+						pos -= 1
+				return pos
+			# Like iterating events: stop at the first one which is not earlier
+			pos = -1
+			for i in xrange(len(self.offsets)):
+				if (contactId <> None) and (self.contactIDs[i] <> contactId):
+					continue
+				if self.timestamps[i] >= timestamp:
+					break
+				pos = i
+			return pos
+
+		# Returns the offset of the last event with timestamp < given, or 0
+		def last_before(self, timestamp, contactId=None):
+			pos = self.position_before(timestamp, contactId)
+			return self.offsets[pos] if pos >= 0 else 0
+
+		# Returns the position of the event (DBEvent or offset + timestamp), or -1
+		def find(self, offset, timestamp=None):
+			if self.sorted and (timestamp <> None):
+				pos = bisect.bisect_left(self.timestamps, timestamp)
+				while (pos < len(self.offsets)) and (self.timestamps[pos] == timestamp):
+					if self.offsets[pos] == offset:
+						return pos
+					pos += 1
+			try:
+				return self.offsets.index(offset)
+			except ValueError:
+				return -1
+
+		# Registers event which has been linked after another one (None: at the start of the chain)
+		def insert_after(self, prev, event):
+			pos = 0
+			if prev <> None:
+				pos = self.find(prev.offset, prev.timestamp) + 1
+			if (pos > 0) and (self.timestamps[pos-1] > event.timestamp):
+				self.sorted = False
+			if (pos < len(self.offsets)) and (self.timestamps[pos] < event.timestamp):
+				self.sorted = False
+			self.timestamps.insert(pos, event.timestamp)
+			self.offsets.insert(pos, event.offset)
+			self.contactIDs.insert(pos, event.contactID)
+
+		# Registers runs of events linked in at once: {position to insert after (-1: start) -> [events]}
+		def splice(self, runs):
+			(timestamps, offsets, contactIDs) = (array('I'), array('I'), array('I'))
+			for pos in xrange(-1, len(self.offsets)):
+				if pos >= 0:
+					timestamps.append(self.timestamps[pos])
+					offsets.append(self.offsets[pos])
+					contactIDs.append(self.contactIDs[pos])
+				for event in runs.get(pos, []):
+					timestamps.append(event.timestamp)
+					offsets.append(event.offset)
+					contactIDs.append(event.contactID)
+			(self.timestamps, self.offsets, self.contactIDs) = (timestamps, offsets, contactIDs)
+			self.sorted = all(timestamps[i-1] <= timestamps[i] for i in xrange(1, len(timestamps)))
+
+		# Forgets the event. Returns False if it wasn't there
+		def remove(self, event):
+			pos = self.find(event.offset, event.timestamp)
+			if pos < 0:
+				return False
+			del self.timestamps[pos]
+			del self.offsets[pos]
+			del self.contactIDs[pos]
+			return True
+
+	# Returns EventIndex for the events hosted by this contact
+	def get_event_index(self, contact):
+		index = self._eventIndexes.get(contact.contactID, None)
+		if index == None:
+			index = self.EventIndex(self, contact)
+			self._eventIndexes[contact.contactID] = index
+		return index
 	
+	# Columnar snapshot of all event headers in the database, one array per field, in chain order
+	# (the user's chain first). Breakdowns are counted over whole columns, with no further reads.
+	class EventTable:
+		#   contacts: only read the chains of these contacts (default: all)
+		def __init__(self, db, contacts=None):
+			self.offsets = array('I')
+			self.hosts = array('I')			# contactID of the contact whose chain hosts the event
+			self.contactIDs = array('I')
+			self.modules = array('I')		# ofsModuleName
+			self.timestamps = array('I')
+			self.flags = array('I')
+			self.types = array('H')
+			self.blobSizes = array('I')
+			if contacts == None:
+				contacts = [db.user] + db.contacts()
+			for contact in contacts:
+				start = len(self.offsets)
+				for event in db.scan_events(contact, header_only=True):
+					self.offsets.append(event.offset)
+					self.contactIDs.append(event.contactID)
+					self.modules.append(event.ofsModuleName)
+					self.timestamps.append(event.timestamp)
+					self.flags.append(event.flags)
+					self.types.append(event.eventType)
+					self.blobSizes.append(event.cbBlob)
+				self.hosts.extend(repeat(contact.contactID, len(self.offsets) - start))
+		def __len__(self):
+			return len(self.offsets)
+
+		COLUMNS = ['offsets', 'hosts', 'contactIDs', 'modules', 'timestamps', 'flags', 'types', 'blobSizes']
+		# Returns the arrays in COLUMNS order (the table itself is a nested class and doesn't pickle)
+		def columns(self):
+			return [getattr(self, column) for column in self.COLUMNS]
+
+		# Appends rows, given as columns()
+		def extend(self, columns):
+			for (column, values) in zip(self.COLUMNS, columns):
+				getattr(self, column).extend(values)
+
+		# Returns Counter({value: number of events}) for a column,
+		# or Counter({(value1, value2, ...): number of events}) for several
+		def count(self, *columns):
+			if len(columns) == 1:
+				return Counter(columns[0])
+			return Counter(izip(*columns))
+
+		# Returns the column only for the events belonging to the given contact
+		def select(self, column, contactId):
+			return compress(column, imap(operator.eq, self.contactIDs, repeat(contactId)))
+
+		# Returns Counter({hour since epoch: number of events})
+		def count_hours(self, contactId=None):
+			timestamps = self.timestamps if contactId == None else self.select(self.timestamps, contactId)
+			return Counter(imap(operator.floordiv, timestamps, repeat(3600)))
+
+		# Returns {hour of day (UTC): number of events}
+		def by_hour(self, contactId=None):
+			ret = dict.fromkeys(xrange(24), 0)
+			for (hour, count) in self.count_hours(contactId).iteritems():
+				ret[hour % 24] += count
+			return ret
+
+		# Returns {(year, month): number of events}, in UTC
+		def by_month(self, contactId=None):
+			days = Counter()
+			for (hour, count) in self.count_hours(contactId).iteritems():
+				days[hour // 24] += count
+			ret = Counter()
+			for (day, count) in days.iteritems():
+				date = datetime.utcfromtimestamp(day * 86400)
+				ret[(date.year, date.month)] += count
+			return dict(ret)
+
+		# Returns {contactID: number of events}
+		def by_contact(self):
+			return dict((int(contactID), count) for (contactID, count) in self.count(self.contactIDs).iteritems())
+
+	# Reads the headers of all events into an EventTable
+	#   jobs: read the chains in this many processes, see parallel_map()
+	def event_table(self, jobs=1):
+		if jobs == 1:
+			return self.EventTable(self)
+		table = self.EventTable(self, [])
+		for part in parallel_map(self, event_table_part, [self.user] + self.contacts(), jobs):
+			table.extend(part)
+		return table
+
 	class EventIter:
 		#  ofsFirst: start with a specific event (normally the contact's first event)
 		#  chain: first events are cached. After the cached part ends, enum continues from the last offset,
 		# expanding the cached chain.
 		#  contactId: skip events unless they belong to the given contact
-		def __init__(self, db, ofsFirst=None, chain=None, contactId=None):
+		#  projection: what to read for each event (EVENT_HEADER/EVENT_BLOB/EVENT_DECODED)
+		def __init__(self, db, ofsFirst=None, chain=None, contactId=None, projection=None):
 			self.db = db
 			self.chain = chain
 			self.chain_idx = 0
 			self.offset = ofsFirst
 			self.contactId = contactId
+			self.projection = projection if projection <> None else db.EVENT_DECODED
 		def __iter__(self):
 			return self
 		def next(self):
@@ -1197,134 +2102,358 @@ class MirandaDbxMmap(object):
 					raise StopIteration()	# before chain_idx+=1, so that we return here every next()
 				self.chain_idx += 1
 				if (self.contactId==None) or (pair[1]==self.contactId):
-					event = self.db.read_event(pair[0])
-					event.data = self.db.decode_event_data(event)
-					return event
+					return self.db.read_event(pair[0], self.projection)
 			# No zero-offset means we should continue from the last event
 			if self.chain and (len(self.chain)>0):
-				last_event = self.db.read_event(self.chain[-1][0])
+				last_event = self.db.read_event_header(self.chain[-1][0])
 				self.offset = last_event.ofsNext
 				# Otherwise we should've been given contact's ofsFirst
 			# Read events one by one
 			event = None
 			while self.offset <> 0:
-				event = self.db.read_event(self.offset)
+				event = self.db.read_event(self.offset, min(self.projection, self.db.EVENT_BLOB))
 				if event==None: break		# Should not happen but verify
 				if self.chain <> None:
 					self.chain.append((self.offset, event.contactID))
 					self.chain_idx += 1		# Or we'll return it from the chain next call :)
 				self.offset = event.ofsNext
 				if (self.contactId == None) or (event.contactID == self.contactId):
-					event.data = self.db.decode_event_data(event)
+					if self.projection == self.db.EVENT_DECODED:
+						event.data = self.db.decode_event_data(event)
 					return event
 			# No more events
 			if self.chain and (self.chain[-1][0]<>0):
 				self.chain.append((0,0))	# Chain terminator
 			raise StopIteration()
 
-	def get_event_iter(self, contact, contactId):
+	# Flyweight cursor for bulk scans: walks the chain starting at ofsFirst, refilling
+	# one DBEventRecord in place at every step. Events are not decoded, and each one is only
+	# valid until the next step, so copy out whatever you need to keep.
+	class EventCursor:
+		def __init__(self, db, ofsFirst, header_only=False):
+			self.db = db
+			self.offset = ofsFirst
+			self.record = DBEventHeaderRecord() if header_only else DBEventRecord()
+		def __iter__(self):
+			return self
+		def next(self):
+			if self.offset == 0:
+				raise StopIteration()
+			event = self.db.read(self.record, self.offset)
+			self.offset = event.ofsNext
+			return event
+
+	#   start: event offset or a DBContact to scan the chain of
+	#   header_only: do not read blobs
+	def scan_events(self, start, header_only=False):
+		if isinstance(start, DBContact):
+			start = start.ofsFirstEvent
+		return self.EventCursor(self, start, header_only)
+
+	def get_event_iter(self, contact, contactId, projection=None):
 		# Event chains for each hoster contact are cached
 		chain = self._eventChains.get(contact.contactID, None)
 		if chain == None:
-			chain = []
+			index = self._eventIndexes.get(contact.contactID, None)
+			chain = index.chain() if index <> None else []
 			self._eventChains[contact.contactID] = chain
-		return self.EventIter(self, contact.ofsFirstEvent, chain, contactId)
+		return self.EventIter(self, contact.ofsFirstEvent, chain, contactId, projection)
 
 	# Retrieves and decodes all events for the contact. Handles MetaContacts transparently.
 	#	contact_id: Return only events for this contactId (MetaContacts can host multiple)
 	#	with_metacontacts: Locate this contact events in MetaContacts too.
 	#		This may be slower than printing out the entire MetaContact once,
 	#		because EVERY subcontact will iterate ALL metacontact events, filtering them.
-	def get_events(self, contact, with_metacontacts=True, contactId=None):
+	#	projection: EVENT_HEADER, EVENT_BLOB or EVENT_DECODED (default). Choose the least you need,
+	#		e.g. for timestamps, flags or contactIDs there's no need to even read the blobs.
+	def get_events(self, contact, with_metacontacts=True, contactId=None, projection=EVENT_DECODED):
 		# MetaContacts can steal events from their children but leave contactId and moduleName intact
 		if (contact.ofsFirstEvent == 0) and (contact.eventCount > 0) and with_metacontacts:
 			metaContact = self.get_meta_contact(contact)
 			if metaContact <> None:
 				contactId2 = contactId if contactId <> None else contact.contactID
-				return self.get_event_iter(metaContact, contactId2)
+				return self.get_event_iter(metaContact, contactId2, projection)
 		# If this is a MetaContact itself, skip events not directly owned by it
 		if with_metacontacts and (contact.protocol == "MetaContacts") and (contactId == None):
 			contactId = contact.contactID
-		return self.get_event_iter(contact, contactId)
+		return self.get_event_iter(contact, contactId, projection)
 	
 	# Returns the last event in the event chain starting with a given event,
 	# or the chain for a given contact
-	def get_last_event(self, event):
+	#	projection: for the returned event. The rest are only read as headers.
+	def get_last_event(self, event, projection=EVENT_HEADER):
 		if isinstance(event, DBContact):
-			event = self.read_event(event.ofsFirstEvent) if event.ofsFirstEvent <> 0 else None
+			event = self.read_event_header(event.ofsFirstEvent) if event.ofsFirstEvent <> 0 else None
 		if event == None:
 			return None
 		while event.ofsNext <> 0:
-			event = self.read_event(event.ofsNext)
+			event = self.read_event_header(event.ofsNext)
+		if projection <> self.EVENT_HEADER:
+			event = self.read_event(event.offset, projection)
 		return event
 	
 	# Returns last event with timestamp < given. For <=, ask for timestamp+1
-	def last_event_before_timestamp(self, contact, timestamp, first=None):
-		result = None
-		for prev_event in self.get_events(contact):
-			if prev_event.timestamp>=timestamp: break
-			result = prev_event
-		return result
+	# Minds MetaContacts the same way get_events() does.
+	def last_event_before_timestamp(self, contact, timestamp, first=None, projection=EVENT_HEADER):
+		host = contact
+		contactId = None
+		if (contact.ofsFirstEvent == 0) and (contact.eventCount > 0):
+			metaContact = self.get_meta_contact(contact)
+			if metaContact <> None:
+				host = metaContact
+				contactId = contact.contactID
+		if (host == contact) and (contact.protocol == "MetaContacts"):
+			contactId = contact.contactID
+		offset = self.get_event_index(host).last_before(timestamp, contactId)
+		return self.read_event(offset, projection) if offset <> 0 else None
+
+	#
+	# Sidecar index
+	#
+	# Module list, contact headers, settings chains and event chain indexes are normally rebuilt
+	# by walking the file on every start. They can be saved next to the database (dbname.idx)
+	# and loaded on the next run, as long as the database size, mtime and header are the same.
+	def index_filename(self):
+		return self.filename + '.idx'
+
+	# Returns DBIndexHeader describing the current state of the database file
+	def index_key(self):
+		self.file.flush()
+		stat = os.fstat(self.file.fileno())
+		key = DBIndexHeader()
+		key.magic = DBIndexHeader.MAGIC
+		key.version = DBIndexHeader.VERSION
+		key.fileSize = stat.st_size
+		key.mtime = stat.st_mtime
+		key.dbHeader = self.header.codec().pack(self.header)
+		return key
+
+	# Loads the sidecar index if there's a valid one for this database. Returns True if loaded.
+	index_loaded = False
+	def load_index(self):
+		try:
+			file = open(self.index_filename(), 'rb')
+		except IOError:
+			return False
+		COUNT = DBIndexHeader.COUNT
+		def read_count():
+			return COUNT.unpack(file.read(COUNT.size))[0]
+		def read_array(count):
+			ret = array('I')
+			ret.fromfile(file, count)
+			return ret
+		with file:
+			try:
+				key = DBIndexHeader()
+				key.read(file)
+				if key.codec().pack(key) <> key.codec().pack(self.index_key()):
+					log.info('Index is stale: '+self.index_filename())
+					return False
+				modules = []
+				for i in xrange(read_count()):
+					offset = read_count()
+					module = DBModuleName()
+					module.read(file)
+					module.offset = offset
+					modules.append(module)
+				contacts = []
+				for i in xrange(read_count()):
+					offset = read_count()
+					contact = DBContact()
+					contact.read(file)
+					contact.offset = offset
+					contact.db = self
+					contacts.append(contact)
+				settingsOffsets = {}
+				for i in xrange(read_count()):
+					offset = read_count()
+					settingsOffsets[offset] = read_array(read_count())
+				eventIndexes = {}
+				for i in xrange(read_count()):
+					(contactId, sorted) = (read_count(), read_count())
+					index = self.EventIndex(self, None)
+					index.sorted = (sorted <> 0)
+					count = read_count()
+					index.timestamps = read_array(count)
+					index.offsets = read_array(count)
+					index.contactIDs = read_array(count)
+					eventIndexes[contactId] = index
+			except (struct.error, SignatureError, EOFError, UnicodeError) as e:
+				log.warning('Cannot read index '+self.index_filename()+': '+str(e))
+				return False
+		self._modules = []
+		self._modulesByOffset = {}
+		self._moduleOffsets = {}
+		for module in modules:
+			self.module_cache_add(module)
+		self._contacts = contacts
+		self.contact_cache_rebuild()
+		self._settingsOffsets = settingsOffsets
+		self._eventIndexes = eventIndexes
+		self._eventChains = {}
+		self.index_loaded = True
+		return True
+
+	# Saves the sidecar index, building whatever is not yet cached. Walks the entire database if needed.
+	def save_index(self):
+		contacts = self.contacts()
+		modules = self.get_modules()
+		for contact in [self.user] + contacts:
+			self.contact_settings_offsets(contact)
+			if contact.ofsFirstEvent <> 0:
+				self.get_event_index(contact)
+		COUNT = DBIndexHeader.COUNT
+		with open(self.index_filename(), 'wb') as file:
+			self.index_key().write(file)
+			file.write(COUNT.pack(len(modules)))
+			for module in modules:
+				file.write(COUNT.pack(module.offset))
+				module.write(file)
+			file.write(COUNT.pack(len(contacts)))
+			for contact in contacts:
+				file.write(COUNT.pack(contact.offset))
+				contact.write(file)
+			file.write(COUNT.pack(len(self._settingsOffsets)))
+			for (offset, offsets) in self._settingsOffsets.items():
+				file.write(COUNT.pack(offset))
+				file.write(COUNT.pack(len(offsets)))
+				offsets.tofile(file)
+			file.write(COUNT.pack(len(self._eventIndexes)))
+			for (contactId, index) in self._eventIndexes.items():
+				file.write(COUNT.pack(contactId))
+				file.write(COUNT.pack(1 if index.sorted else 0))
+				file.write(COUNT.pack(len(index)))
+				index.timestamps.tofile(file)
+				index.offsets.tofile(file)
+				index.contactIDs.tofile(file)
+		self.index_loaded = True
+		self.modified = False
+
+	# Saves the sidecar index unless the one loaded is still up to date
+	def update_index(self):
+		if self.modified or not self.index_loaded:
+			self.save_index()
+
+	#
+	# Compaction
+	#
+	# Writes a compacted copy of the database to a new file. Everything reachable is laid out in order:
+	#   header, modules, contacts (user first), settings, events (chain by chain, in chain order)
+	# slackSpace is zero in the copy. Returns {old offset -> new offset} for every structure copied.
+	def compact(self, filename):
+		map = {}
+		offset = self.header.size()
+		modules = self.get_modules()
+		for module in modules:
+			map[module.offset] = offset
+			offset += module.size()
+		contacts = [self.user] + self.contacts()
+		for contact in contacts:
+			map[contact.offset] = offset
+			offset += contact.size()
+		settingsSize = DBContactSettings.codec().size
+		extraModules = []	# referenced but not in the module chain
+		def module_offset(ofsModule):
+			if not ofsModule in map:
+				module = self.read_module(ofsModule)
+				ofsChained = self.find_module_name(module.name)
+				if ofsChained <> None:
+					map[ofsModule] = map[ofsChained]
+				else:
+					extraModules.append(module)
+					map[ofsModule] = 0		# allocated after everything else
+			return map[ofsModule]
+		for contact in contacts:
+			for ofsSettings in self.contact_settings_offsets(contact):
+				settings = self.read(DBContactSettings(), ofsSettings)
+				module_offset(settings.ofsModuleName)
+				map[ofsSettings] = offset
+				offset += settingsSize + settings.cbBlob
+		chains = []			# offsets of events in each contact's chain
+		for contact in contacts:
+			chain = array('I')
+			for event in self.scan_events(contact, header_only=True):
+				if event.offset in map:
+					log.warning('Event '+str(event.offset)+' is linked twice, cutting the chain of #'+str(contact.contactID))
+					break
+				module_offset(event.ofsModuleName)
+				map[event.offset] = offset
+				offset += event.size()
+				chain.append(event.offset)
+			chains.append(chain)
+		for module in extraModules:
+			map[module.offset] = offset
+			offset += module.size()
+		
+		# Everything's allocated, write out with the pointers mapped
+		def mapped(ofs):
+			return map.get(ofs, 0) if ofs <> 0 else 0
+		with open(filename, 'wb') as file:
+			header = copy.copy(self.header)
+			header.ofsFileEnd = offset
+			header.slackSpace = 0
+			header.contactCount = len(contacts) - 1
+			header.ofsFirstContact = map[contacts[1].offset] if len(contacts) > 1 else 0
+			header.ofsUser = map[self.user.offset]
+			header.ofsModuleNames = map[modules[0].offset] if modules else 0
+			header.write(file)
+			for i in xrange(len(modules)):
+				module = copy.copy(modules[i])
+				module.ofsNext = map[modules[i+1].offset] if i+1 < len(modules) else 0
+				module.write(file)
+			for i in xrange(len(contacts)):
+				contact = DBContact()
+				for field in DBContact.FIELDS:
+					setattr(contact, field, getattr(contacts[i], field))
+				contact.ofsNext = map[contacts[i+1].offset] if (i > 0) and (i+1 < len(contacts)) else 0
+				offsets = self.contact_settings_offsets(contacts[i])
+				contact.ofsFirstSettings = map[offsets[0]] if len(offsets) > 0 else 0
+				chain = chains[i]
+				contact.ofsFirstEvent = map[chain[0]] if len(chain) > 0 else 0
+				contact.ofsLastEvent = map[chain[-1]] if len(chain) > 0 else 0
+				contact.ofsFirstUnread = mapped(contact.ofsFirstUnread)
+				contact.write(file)
+			for contact in contacts:
+				offsets = self.contact_settings_offsets(contact)
+				for j in xrange(len(offsets)):
+					settings = self.read(DBContactSettings(), offsets[j])
+					settings.ofsNext = map[offsets[j+1]] if j+1 < len(offsets) else 0
+					settings.ofsModuleName = map[settings.ofsModuleName]
+					settings.write(file)
+			event = DBEventRecord()
+			for chain in chains:
+				for j in xrange(len(chain)):
+					self.read(event, chain[j])
+					event.ofsPrev = map[chain[j-1]] if j > 0 else 0
+					event.ofsNext = map[chain[j+1]] if j+1 < len(chain) else 0
+					event.ofsModuleName = map[event.ofsModuleName]
+					event.write(file)
+			for module in extraModules:
+				module.ofsNext = 0
+				module.write(file)
+			assert(file.tell() == offset)
+		return map
 	
 	# Returns a class that can be vars()ed
 	def decode_event_data(self, event):
-		_unicode = (event.DBEF_UTF & event.flags) <> 0
-		proto = self.get_base_proto(event.ofsModuleName)
-		if event.flags & event.DBEF_ENCRYPTED: # Can't decrypt, return hex
-			ret = MessageBlob(
-				type = 'encrypted',
-				hex = event.blob.encode('hex'),
-				unicode = _unicode
-			)
-		elif event.eventType==event.EVENTTYPE_MESSAGE:
-			ret = self.decode_event_data_string(event, _unicode)
-		elif event.eventType==event.EVENTTYPE_URL:
-			ret = DBURLBlob(event.blob, _unicode)
-		elif event.eventType==event.EVENTTYPE_CONTACTS:
-			ret = DBContactsBlob(event.blob, _unicode)
-		elif event.eventType==event.EVENTTYPE_ADDED:
-			ret = DBAuthBlob(event.blob, _unicode)
-		elif event.eventType==event.EVENTTYPE_AUTHREQUEST:
-			ret = DBAuthRequestBlob(event.blob, _unicode)
-		elif event.eventType==event.EVENTTYPE_FILE:
-			ret = DBFileBlob(event.blob, _unicode)
-		elif event.eventType==event.EVENTTYPE_STATUSCHANGE:
-			# Both NewXStatusNotify and TabSRMM produce this as UTF8 DBEF_UTF
-			# The text is freeform and expects adding nickname at the beginning:
-			#	"signed off."
-			#	"signed on and is now %s."
-			#	"changed status from %s to %s."
-			ret = self.decode_event_data_string(event, _unicode)
-		elif event.eventType==event.EVENTTYPE_AVATAR_CHANGE:
-			ret = DBAvatarChangeBlob(event.blob, _unicode)
-		elif (proto=='ICQ') and (event.eventType==event.ICQEVENTTYPE_MISSEDMESSAGE):
-			ret = DBICQMissedMessageBlob(event.blob)
-		elif (proto=='ICQ') and (event.eventType==event.ICQEVENTTYPE_SMS):
-			ret = DBICQSMSBlob(event.blob)
-		elif (proto=='ICQ') and (event.eventType==event.ICQEVENTTYPE_SMSCONFIRMATION):
-			ret = DBICQSMSConfirmationBlob(event.blob)
-		elif (proto=='ICQ') and (event.eventType==event.ICQEVENTTYPE_WEBPAGER):
-			ret = DBICQWebPagerBlob(event.blob)
-		elif (proto=='ICQ') and (event.eventType==event.ICQEVENTTYPE_EMAILEXPRESS):
-			ret = DBICQEmailExpressBlob(event.blob)
-		elif (proto=='JABBER') and (event.eventType==event.EVENTTYPE_JABBER_PRESENCE):
-			ret = DBJabberPresenceBlob(event.blob)
-		elif (proto=='JABBER') and (event.eventType==event.EVENTTYPE_JABBER_CHATSTATES):
-			ret = DBJabberChatStatesBlob(event.blob)
-		elif (proto=='VKontakte') and (event.eventType==event.VK_USER_DEACTIVATE_ACTION):
-			ret = DBVKontakteUserDeactivateActionBlob(event.blob)
-		else:
-			ret = MessageBlob(
-				type = 'unsupported',
-				hex = event.blob.encode('hex'),
-				unicode = _unicode
-			)
+		ret = self.get_decoder(event)(self, event, (event.DBEF_UTF & event.flags) <> 0)
 		if hasattr(ret, 'problem'):
 			clname = ret.__class__.__name__ # or 'Event'
 			log.warning(clname+'@'+str(event.offset)+': '+ret.problem)
 			ret.hex = event.blob.encode('hex')	# Full message hex for debugging
 		return ret
 	
+	# Returns the EventDecoder for the event, see register_decoder()
+	def get_decoder(self, event):
+		if event.flags & event.DBEF_ENCRYPTED:
+			return _encryptedDecoder
+		decoders = _protoDecoders.get(event.eventType, None)
+		if decoders <> None:	# only look up the protocol when it matters
+			decoder = decoders.get(self.get_base_proto(event.ofsModuleName), None)
+			if decoder <> None:
+				return decoder
+		return _typeDecoders.get(event.eventType, _unsupportedDecoder)
+
 	# Decodes event data as simple string
 	def decode_event_data_string(self, event, _unicode):
 		# Most event blobs are strings in one of the THREE formats:
@@ -1418,12 +2547,323 @@ class MirandaDbxMmap(object):
 		return ret
 
 
+#
+# Full-text search
+#
+# Inverted index of event texts, token -> event offsets, stored in an SQLite file next to the database.
+# For each chain it remembers the first/last event and the event count it has covered, so that
+# update() only indexes the events appended since. Chains changed in any other way are reindexed.
+class SearchIndex(object):
+	SCHEMA = [
+		'CREATE TABLE IF NOT EXISTS chains (host INTEGER PRIMARY KEY, ofsFirstEvent INTEGER, ofsLastEvent INTEGER, eventCount INTEGER)',
+		'CREATE TABLE IF NOT EXISTS events (offset INTEGER PRIMARY KEY, host INTEGER, contactID INTEGER, timestamp INTEGER)',
+		'CREATE INDEX IF NOT EXISTS events_host ON events (host)',
+		'CREATE TABLE IF NOT EXISTS postings (token TEXT, offset INTEGER, PRIMARY KEY (token, offset)) WITHOUT ROWID',
+		'CREATE INDEX IF NOT EXISTS postings_offset ON postings (offset)',
+	]
+	TOKEN = re.compile(r'\w+', re.UNICODE)
+
+	def __init__(self, db, filename=None):
+		self.db = db
+		self.filename = filename or (db.filename + '.search')
+		self.conn = sqlite3.connect(self.filename)
+		for sql in self.SCHEMA:
+			self.conn.execute(sql)
+
+	@classmethod
+	def tokenize(cl, text):
+		return cl.TOKEN.findall(text.lower())
+
+	# Returns all searchable text of the decoded event data
+	@staticmethod
+	def event_text(data):
+		parts = []
+		for value in vars(data).values():
+			if isinstance(value, unicode):
+				parts.append(value)
+			elif isinstance(value, list):
+				parts += [item for item in value if isinstance(item, unicode)]
+		return u'\n'.join(parts)
+
+	# Brings the index up to date with the database. Returns the number of events indexed.
+	def update(self):
+		count = 0
+		chains = dict((row[0], row[1:]) for row in self.conn.execute('SELECT host, ofsFirstEvent, ofsLastEvent, eventCount FROM chains'))
+		with self.conn:
+			for contact in [self.db.user] + self.db.contacts():
+				state = (contact.ofsFirstEvent, contact.ofsLastEvent, contact.eventCount)
+				covered = chains.pop(contact.contactID, None)
+				if covered == state:
+					continue
+				start = contact.ofsFirstEvent
+				if (covered <> None) and (covered[0] == contact.ofsFirstEvent) and (covered[1] <> 0):
+					start = self.db.read_event_header(covered[1]).ofsNext
+					(added, last) = self.index_chain(contact, start)
+					# The last covered event may have been deleted since, then its ofsNext leads nowhere
+					if (covered[2] + added == contact.eventCount) and ((last or covered[1]) == contact.ofsLastEvent):
+						count += added
+						self.set_covered(contact.contactID, state)
+						continue
+					log.info('Chain of #'+str(contact.contactID)+' has changed, reindexing')
+				self.drop_chain(contact.contactID)
+				count += self.index_chain(contact, contact.ofsFirstEvent)[0]
+				self.set_covered(contact.contactID, state)
+			for host in chains.keys():		# contacts gone
+				self.drop_chain(host)
+		return count
+
+	def set_covered(self, host, state):
+		self.conn.execute('INSERT OR REPLACE INTO chains VALUES (?, ?, ?, ?)', (host,) + state)
+
+	def drop_chain(self, host):
+		self.conn.execute('DELETE FROM postings WHERE offset IN (SELECT offset FROM events WHERE host=?)', (host,))
+		self.conn.execute('DELETE FROM events WHERE host=?', (host,))
+		self.conn.execute('DELETE FROM chains WHERE host=?', (host,))
+
+	# Indexes the events of the contact's chain, starting at the given one.
+	# Returns their number and the offset of the last one (0 if there were none).
+	def index_chain(self, contact, start):
+		events = []
+		postings = []
+		for event in self.db.scan_events(start):
+			events.append((event.offset, contact.contactID, event.contactID, event.timestamp))
+			text = self.event_text(self.db.decode_event_data(event))
+			for token in set(self.tokenize(text)):
+				postings.append((token, event.offset))
+		self.conn.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)', events)
+		self.conn.executemany('INSERT OR IGNORE INTO postings VALUES (?, ?)', postings)
+		return (len(events), events[-1][0] if events else 0)
+
+	# Returns offsets of the events which contain all tokens of the query, ordered by timestamp.
+	# Phrases ("quoted") must be in the text as they are, which is verified by decoding the candidates.
+	#   contactIDs: only events belonging to these contacts
+	#   since, until: timestamp range, inclusive
+	def search(self, query, contactIDs=None, since=None, until=None):
+		tokens = self.tokenize(query)
+		if len(tokens) <= 0:
+			return []
+		tokens = list(set(tokens))
+		sql = ('SELECT events.offset FROM postings JOIN events ON events.offset = postings.offset'
+			+ ' WHERE token IN (' + ', '.join(['?'] * len(tokens)) + ')')
+		params = list(tokens)
+		if contactIDs <> None:
+			sql += ' AND contactID IN (' + ', '.join(['?'] * len(contactIDs)) + ')'
+			params += list(contactIDs)
+		if since <> None:
+			sql += ' AND timestamp >= ?'
+			params.append(since)
+		if until <> None:
+			sql += ' AND timestamp <= ?'
+			params.append(until)
+		sql += ' GROUP BY events.offset HAVING COUNT(*) = ? ORDER BY timestamp, events.offset'
+		params.append(len(tokens))
+		offsets = [row[0] for row in self.conn.execute(sql, params)]
+		phrases = [u' '.join(self.tokenize(phrase)) for phrase in re.findall(r'"([^"]*)"', query)]
+		phrases = [phrase for phrase in phrases if phrase.count(u' ') > 0]
+		if phrases:
+			offsets = [offset for offset in offsets if self.has_phrases(offset, phrases)]
+		return offsets
+
+	def has_phrases(self, offset, phrases):
+		event = self.db.read_event(offset, self.db.EVENT_DECODED)
+		text = u' ' + u' '.join(self.tokenize(self.event_text(event.data))) + u' '
+		for phrase in phrases:
+			if not (u' ' + phrase + u' ') in text:
+				return False
+		return True
+
+	def close(self):
+		self.conn.close()
+
+
+#
+# SQLite export
+#
+# Streams the whole database into a new SQLite file in a single pass: rows are inserted in batches
+# and committed every COMMIT_ROWS, events are scanned with a cursor and never kept. Indexes are
+# created after the load.
+# Modules and contacts are referenced by offset and contactID. Events record both the host contact
+# (whose chain they are in, e.g. a metacontact) and the owner contactID.
+# Damaged databases can have duplicate contactIDs and events linked into several chains, so contacts
+# and events are keyed by rowid and exported as they are found.
+class SqliteExport(object):
+	SCHEMA = [
+		'CREATE TABLE modules (offset INTEGER PRIMARY KEY, name TEXT)',
+		'CREATE TABLE contacts (contactID INTEGER, offset INTEGER, protocol TEXT, uin, display_name TEXT, nick TEXT, metaID INTEGER, eventCount INTEGER)',
+		'CREATE TABLE settings (contactID INTEGER, module INTEGER, name TEXT, type INTEGER, value)',
+		'CREATE TABLE events (offset INTEGER, host INTEGER, contactID INTEGER, timestamp INTEGER, module INTEGER, eventType INTEGER, flags INTEGER, cbBlob INTEGER, type TEXT, text TEXT, problem TEXT)',
+	]
+	INDEXES = [
+		'CREATE INDEX contacts_id ON contacts (contactID)',
+		'CREATE INDEX settings_contact ON settings (contactID, module)',
+		'CREATE INDEX events_offset ON events (offset)',
+		'CREATE INDEX events_host ON events (host, timestamp)',
+		'CREATE INDEX events_contact ON events (contactID, timestamp)',
+		'CREATE INDEX events_timestamp ON events (timestamp)',
+	]
+	BATCH_ROWS = 5000		# rows per executemany()
+	COMMIT_ROWS = 200000	# rows per transaction
+
+	def __init__(self, db, filename):
+		self.db = db
+		self.conn = sqlite3.connect(filename)
+		# A fresh file that is useless if the export fails midway, so no need for the journal
+		self.conn.execute('PRAGMA journal_mode = OFF')
+		self.conn.execute('PRAGMA synchronous = OFF')
+		for sql in self.SCHEMA:
+			self.conn.execute(sql)
+		self.modules = set()	# offsets of the exported modules
+		self.pending = 0		# rows since the last commit
+		self.counts = {}		# table -> rows exported
+
+	# Runs the export. Returns {table -> row count}.
+	def export(self):
+		for module in self.db.get_modules():
+			self.add_module(module.offset, module.name)
+		contacts = [self.db.user] + self.db.contacts()
+		self.insert('contacts', self.contact_rows(contacts))
+		for contact in contacts:
+			self.insert('settings', self.settings_rows(contact))
+		for contact in contacts:
+			self.insert('events', self.event_rows(contact))
+		self.conn.commit()
+		for sql in self.INDEXES:
+			self.conn.execute(sql)
+		self.conn.commit()
+		return self.counts
+
+	def add_module(self, offset, name):
+		self.modules.add(offset)
+		self.insert('modules', [(offset, name)])
+
+	# Events and settings may reference module names which are not in the module chain
+	def module_ref(self, offset):
+		if not offset in self.modules:
+			name = self.db.get_module_name(offset)
+			if name == None:
+				name = self.db.read_module(offset).name
+			self.add_module(offset, name)
+		return offset
+
+	# Inserts rows from the iterable in batches
+	def insert(self, table, rows):
+		sql = None
+		batch = []
+		for row in rows:
+			batch.append(row)
+			if len(batch) >= self.BATCH_ROWS:
+				sql = self.flush(table, batch, sql)
+				batch = []
+		if batch:
+			self.flush(table, batch, sql)
+
+	def flush(self, table, batch, sql):
+		if sql == None:
+			sql = 'INSERT INTO '+table+' VALUES ('+', '.join(['?'] * len(batch[0]))+')'
+		self.conn.executemany(sql, batch)
+		self.counts[table] = self.counts.get(table, 0) + len(batch)
+		self.pending += len(batch)
+		if self.pending >= self.COMMIT_ROWS:
+			self.conn.commit()
+			self.pending = 0
+		return sql
+
+	def contact_rows(self, contacts):
+		for contact in contacts:
+			yield (contact.contactID, contact.offset, contact.protocol, self.value(contact.uin),
+				contact.display_name, contact.nick, contact.get_meta_parent(), contact.eventCount)
+
+	# Reads the settings without caching them in the contact
+	def settings_rows(self, contact):
+		for ofsSettings in self.db.contact_settings_offsets(contact):
+			module = self.db.read_settings_header(ofsSettings)
+			ofsModule = self.module_ref(module.ofsModuleName)
+			for setting in module.settings().values():
+				yield (contact.contactID, ofsModule, setting.name, setting.type, self.value(setting.value))
+
+	def event_rows(self, contact):
+		for event in self.db.scan_events(contact):
+			data = self.db.decode_event_data(event)
+			yield (event.offset, contact.contactID, event.contactID, event.timestamp,
+				self.module_ref(event.ofsModuleName), event.eventType, event.flags, event.cbBlob,
+				getattr(data, 'type', None), SearchIndex.event_text(data), getattr(data, 'problem', None))
+
+	# Converts a setting value to something SQLite can store
+	@staticmethod
+	def value(value):
+		if isinstance(value, DBSetting.Deleted):
+			return None
+		if isinstance(value, str):		# Bytes, and plain strs which may not be ASCII
+			return buffer(value)
+		return value
+
+	def close(self):
+		self.conn.close()
+
+
+#
+# Parallel passes
+#
+# Whole-database passes can spread the contacts' chains over a pool of processes. Each worker opens
+# its own read-only copy of the database, so func and its arguments must be picklable (module-level
+# functions), and only contact offsets are sent over.
+_workerDb = None
+
+def _parallel_init(dbclass, filename, use_mmap, loglevel):
+	global _workerDb
+	coreutils.init_logging(loglevel)
+	_workerDb = dbclass(filename, use_mmap=use_mmap)
+
+# Returns the result and the decoder counters it has changed: {name -> (calls, failures, time)}
+def _parallel_call(task):
+	(func, ofsContact, args) = task
+	before = dict((decoder.name, (decoder.calls, decoder.failures, decoder.time)) for decoder in get_decoders())
+	contact = _workerDb.contact_by_offset(ofsContact)
+	ret = func(_workerDb, contact, *args)
+	stats = {}
+	for decoder in get_decoders():
+		(calls, failures, time) = before.get(decoder.name, (0, 0, 0.0))
+		if decoder.calls <> calls:
+			stats[decoder.name] = (decoder.calls - calls, decoder.failures - failures, decoder.time - time)
+	return (ret, stats)
+
+# Runs func(db, contact, *args) for every contact and yields the results in the order of the contacts.
+#   jobs: number of worker processes; 1 to run everything here, None/0 for one per CPU
+# Decoder counters from the workers are added to the ones in this process.
+def parallel_map(db, func, contacts, jobs, args=()):
+	if jobs == 1:
+		for contact in contacts:
+			yield func(db, contact, *args)
+		return
+	decoders = dict((decoder.name, decoder) for decoder in get_decoders())
+	pool = multiprocessing.Pool(jobs or None, _parallel_init,
+		(db.__class__, db.filename, db.mm <> None, logging.getLogger().getEffectiveLevel()))
+	try:
+		for (ret, stats) in pool.imap(_parallel_call, [(func, contact.offset, args) for contact in contacts]):
+			for (name, (calls, failures, time)) in stats.items():
+				decoder = decoders.get(name, None)
+				if decoder <> None:
+					decoder.calls += calls
+					decoder.failures += failures
+					decoder.time += time
+			yield ret
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+def event_table_part(db, contact):
+	return db.EventTable(db, [contact]).columns()
+
+
 # Can be called manually for testing
 def main():
 	parser = argparse.ArgumentParser(description="Parse and print Miranda.",
 		parents=[coreutils.argparser()])
 	parser.add_argument("dbname", help='path to database file')
 	parser.add_argument("--write", help='opens the database for writing (WARNING: enables editing functions!)', action='store_true')
+	parser.add_argument("--mmap", help='maps the database into memory and decodes it in place (faster with large databases)', action='store_true')
+	parser.add_argument("--index", help='keeps a sidecar index next to the database (dbname.idx) for faster reopening', action='store_true')
 	subparsers = parser.add_subparsers(title='subcommands')
 	
 	sparser = subparsers.add_parser('dump-modules', help='prints all module names')
@@ -1432,7 +2872,7 @@ def main():
 	sparser.set_defaults(func=dump_modules)
 	
 	sparser = subparsers.add_parser('add-module', help='adds a new module to the database')
-	sparser.add_argument('module-name', type=str, nargs='+', help='add module with this name')
+	sparser.add_argument('module_name', metavar='module-name', type=str, nargs='+', help='add module with this name')
 	sparser.set_defaults(func=add_module)
 	
 	sparser = subparsers.add_parser('dump-contacts', help='prints contacts')
@@ -1445,6 +2885,11 @@ def main():
 	sparser.set_defaults(func=dump_settings)
 	
 	sparser = subparsers.add_parser('event-stats', help='collects event statistics')
+	sparser.add_argument('--blob-sizes', action='store_true', help='also count events by blob size')
+	sparser.add_argument('--by-contact', action='store_true', help='also count events by contactID')
+	sparser.add_argument('--by-month', action='store_true', help='also count events by month (UTC)')
+	sparser.add_argument('--by-hour', action='store_true', help='also count events by hour of day (UTC)')
+	sparser.add_argument('--jobs', type=int, default=1, help='read the event chains in this many processes (0: one per CPU)')
 	sparser.set_defaults(func=event_stats)
 	
 	sparser = subparsers.add_parser('dump-events', help='prints all events for the given contacts')
@@ -1453,6 +2898,8 @@ def main():
 	sparser.add_argument("--bad", help='dumps only bad events', action='store_true')
 	sparser.add_argument("--unsupported", help='dumps only unsupported events', action='store_true')
 	sparser.add_argument("--low", help='print low-level info', action='store_true')
+	sparser.add_argument("--decoder-stats", help='print call/failure counts and time spent for each event decoder', action='store_true')
+	sparser.add_argument("--jobs", type=int, default=1, help='decode the contacts in this many processes (0: one per CPU)')
 	sparser.set_defaults(func=dump_events)
 
 	sparser = subparsers.add_parser('dump-event', help='prints the specific events')
@@ -1472,13 +2919,34 @@ def main():
 	sparser.add_argument('offset', type=int, nargs='+', help='offset to delete an event at')
 	sparser.set_defaults(func=delete_event)
 
+	sparser = subparsers.add_parser('compact', help='writes a compacted copy of the database, with no slack space and every event chain stored in order')
+	sparser.add_argument('output', type=str, help='path to the new database file')
+	sparser.add_argument('--offset-map', type=str, metavar='file', help='write "old_offset new_offset" lines for all copied structures to this file (to fix up stored event offsets)')
+	sparser.set_defaults(func=compact)
+
+	sparser = subparsers.add_parser('search', help='searches event texts, using an index next to the database (dbname.search)')
+	sparser.add_argument('query', type=str, nargs='+', help='words that must all be in the event; "quoted phrases" must be there as they are')
+	sparser.add_argument('--contact', type=str, nargs='*', help='search only events of these contacts')
+	sparser.add_argument('--since', type=int, metavar='timestamp', help='search only events at or after this time')
+	sparser.add_argument('--until', type=int, metavar='timestamp', help='search only events at or before this time')
+	sparser.add_argument('--index-file', type=str, metavar='file', help='use this index file (default: dbname.search)')
+	sparser.add_argument('--no-update', action='store_true', help='do not index new events first')
+	sparser.set_defaults(func=search)
+
+	sparser = subparsers.add_parser('export-sqlite', help='exports modules, contacts, settings and events with their decoded texts into an SQLite database')
+	sparser.add_argument('output', type=str, help='path to the SQLite file to create')
+	sparser.add_argument('--force', action='store_true', help='overwrite the output file if it exists')
+	sparser.set_defaults(func=export_sqlite)
+
 	args = parser.parse_args()
 	coreutils.init(args)
 	
-	db = MirandaDbxMmap(args.dbname, writeable=args.write)
+	db = MirandaDbxMmap(args.dbname, writeable=args.write, use_mmap=args.mmap, use_index=args.index)
 	
 	if args.func <> None:
 		args.func(db, args)
+	if args.index:
+		db.update_index()
 
 
 def dump_modules(db, args):
@@ -1518,7 +2986,8 @@ def dump_contacts(db, args):
 	totalEvents = 0
 	for contact in select_contacts_opt(db, args.contact):
 		if args.low:
-			pprint.pprint(vars(contact))
+			db.expand_contact(contact)
+			pprint.pprint(dict((key, value) for (key, value) in vars(contact).items() if key <> 'db'))
 			continue
 		print unicode(contact.display_name)
 		print u"  Protocol: "+unicode(contact.protocol)
@@ -1545,54 +3014,56 @@ def dump_settings(db, args):
 
 
 def event_stats(db, args):
+	table = db.event_table(args.jobs)
 	stats = {}
-	stats['count'] = 0
+	stats['count'] = len(table)
 	stats['flags'] = {'sent': 0, 'read': 0, 'rtl': 0, 'utf': 0, 'encrypted': 0, 'other': 0}
 	stats['unknown_flags'] = 0  # collects unknown bit flags
 	stats['modules'] = {}
 	stats['types'] = {}
-	stats['blobSizes'] = {}
-	event_stats_contact(db, db.user, stats)
-	for contact in db.contacts():
-		event_stats_contact(db, contact, stats)
-	del stats['blobSizes'] # no point printing, too many messages of any size
-	pprint.pprint(stats)
-
-def event_stats_contact(db, contact, stats):
-	ofsEvent = contact.ofsFirstEvent
-	while ofsEvent <> 0:
-		event = db.read(DBEvent(), ofsEvent)
-		stats['count'] += 1
-		
-		moduleName = db.get_module_name(event.ofsModuleName)
+	
+	# Few distinct values in each column, so only classify those
+	moduleNames = {}
+	for ofsModuleName in set(table.modules):
+		moduleName = db.get_module_name(ofsModuleName)
 		moduleProto = db.get_base_proto(moduleName)
-		if moduleProto <> None:
-			moduleName = moduleProto
-		s_modules = stats['modules']
-		s_modules[moduleName] = s_modules.get(moduleName, 0) + 1
-		
-		s_flags = stats['flags']
-		if event.flags & event.DBEF_SENT:			s_flags['sent'] += 1
-		elif event.flags & event.DBEF_READ:			s_flags['read'] += 1
-		elif event.flags & event.DBEF_RTL:			s_flags['rtl'] += 1
-		elif event.flags & event.DBEF_UTF:			s_flags['utf'] += 1
-		elif event.flags & event.DBEF_ENCRYPTED:	s_flags['encrypted'] += 1
-		other_flags = event.flags & ~(event.DBEF_SENT | event.DBEF_READ | event.DBEF_RTL | event.DBEF_UTF | event.DBEF_ENCRYPTED)
+		moduleNames[ofsModuleName] = moduleProto if moduleProto <> None else moduleName
+	
+	s_modules = stats['modules']
+	for (ofsModuleName, count) in table.count(table.modules).iteritems():
+		moduleName = moduleNames[ofsModuleName]
+		s_modules[moduleName] = s_modules.get(moduleName, 0) + count
+	
+	s_flags = stats['flags']
+	for (flags, count) in table.count(table.flags).iteritems():
+		if flags & DBEvent.DBEF_SENT:			s_flags['sent'] += count
+		elif flags & DBEvent.DBEF_READ:			s_flags['read'] += count
+		elif flags & DBEvent.DBEF_RTL:			s_flags['rtl'] += count
+		elif flags & DBEvent.DBEF_UTF:			s_flags['utf'] += count
+		elif flags & DBEvent.DBEF_ENCRYPTED:	s_flags['encrypted'] += count
+		other_flags = flags & ~(DBEvent.DBEF_SENT | DBEvent.DBEF_READ | DBEvent.DBEF_RTL | DBEvent.DBEF_UTF | DBEvent.DBEF_ENCRYPTED)
 		if other_flags <> 0:
-			s_flags['other'] += 1
+			s_flags['other'] += count
 			stats['unknown_flags'] = stats['unknown_flags'] | other_flags
-		
-		if event.eventType >= event.EVENTTYPE_MODULE_START:
-			eventKey = (moduleName, event.eventType)
+	
+	s_types = stats['types']
+	for ((eventType, ofsModuleName), count) in table.count(table.types, table.modules).iteritems():
+		if eventType >= DBEvent.EVENTTYPE_MODULE_START:
+			eventKey = (moduleNames[ofsModuleName], eventType)
 		else:
-			eventKey = event.eventType
-		s_types = stats['types']
-		s_types[eventKey] = s_types.get(eventKey, 0) + 1
-		
-		s_blobSizes = stats['blobSizes']
-		s_blobSizes[event.cbBlob] = s_blobSizes.get(event.cbBlob, 0) + 1
-		
-		ofsEvent = event.ofsNext
+			eventKey = eventType
+		s_types[eventKey] = s_types.get(eventKey, 0) + count
+	
+	# Not printed by default, too many messages of any size
+	if args.blob_sizes:
+		stats['blobSizes'] = dict((int(size), count) for (size, count) in table.count(table.blobSizes).iteritems())
+	if args.by_contact:
+		stats['contacts'] = table.by_contact()
+	if args.by_month:
+		stats['months'] = table.by_month()
+	if args.by_hour:
+		stats['hours'] = table.by_hour()
+	pprint.pprint(stats)
 
 def dump_event(db, args):
 	for offset in args.offset:
@@ -1603,24 +3074,39 @@ def dump_event(db, args):
 			print format_event(db, event)
 
 def dump_events(db, args):
+	options = (args.nometa, args.bad, args.unsupported, args.low)
+	for lines in parallel_map(db, dump_events_contact, select_contacts_opt(db, args.contact), args.jobs, options):
+		for line in lines:
+			print line
+	if args.decoder_stats:
+		print_decoder_stats()
+
+# Returns the lines to print for the contact
+def dump_events_contact(db, contact, nometa, bad, unsupported, low):
 	def should_print_event(event):
-		if args.bad and hasattr(data, 'problem'):
+		if bad and hasattr(data, 'problem'):
 			return True
-		if args.unsupported and (getattr(data, 'type', None) in ['unsupported', 'encrypted']):
+		if unsupported and (getattr(data, 'type', None) in ['unsupported', 'encrypted']):
 			return True
-		return not (args.bad or args.unsupported)
-	for contact in select_contacts_opt(db, args.contact):
-		print "Events for "+contact.display_name+": "
-		for event in db.get_events(contact, with_metacontacts=not (args.nometa)):
-			data = event.data
-			if hasattr(data, 'problem'):
-				data.offset = event.offset
-			if not should_print_event(event):
-				continue
-			if args.low:
-				print str(vars(event))
-			else:
-				print format_event(db, event, data)
+		return not (bad or unsupported)
+	lines = ["Events for "+contact.display_name+": "]
+	for event in db.get_events(contact, with_metacontacts=not (nometa)):
+		data = event.data
+		if hasattr(data, 'problem'):
+			data.offset = event.offset
+		if not should_print_event(event):
+			continue
+		if low:
+			lines.append(str(vars(event)))
+		else:
+			lines.append(format_event(db, event, data))
+	return lines
+
+def print_decoder_stats():
+	print "Decoders:"
+	for decoder in sorted(get_decoders(), key=lambda decoder: decoder.time, reverse=True):
+		if decoder.calls <= 0: continue
+		print "  %-40s calls: %-8d failures: %-8d time: %.3fs" % (decoder.name, decoder.calls, decoder.failures, decoder.time)
 
 # Produces a pretty line describing the event
 def format_event(db, event, data = None):
@@ -1656,16 +3142,60 @@ def add_event(db, args):
 		event.timestamp = args.timestamp
 	else:
 		event.timestamp = calendar.timegm(datetime.now().timetuple())
+	insert_after = args.after
 	if (args.after <> None) and (args.after > 0):
-		insert_after = db.read_event(args.after)	# verify that it's an event
+		insert_after = db.read_event_header(args.after)	# verify that it's an event
 	event.flags = event.DBEF_UTF
 	event.eventType = 0
 	event.blob = args.text.encode('utf-8')
-	db.add_event(event, contact, insert_after=args.after)
+	# Not passing the contact: events for meta children go to their meta's chain
+	db.add_event(event, insert_after=insert_after)
 
 def delete_event(db, args):
-	for offset in args.offset:
-		db.delete_event(offset)	# Will verify that it's an event
+	with db.batch():
+		for offset in args.offset:
+			db.delete_event(offset)	# Will verify that it's an event
+
+def search(db, args):
+	index = SearchIndex(db, args.index_file)
+	if not args.no_update:
+		count = index.update()
+		if count > 0:
+			log.info('Indexed '+str(count)+' events')
+	contactIDs = None
+	if args.contact:
+		contactIDs = set(contact.contactID for contact in select_contacts(db, args.contact))
+	query = ' '.join(arg.decode(locale.getpreferredencoding()) for arg in args.query)
+	for offset in index.search(query, contactIDs, args.since, args.until):
+		event = db.read_event(offset, db.EVENT_DECODED)
+		print format_event(db, event, event.data)
+	index.close()
+
+def export_sqlite(db, args):
+	if os.path.exists(args.output):
+		if not args.force:
+			raise Exception("Output file already exists: "+args.output)
+		os.remove(args.output)
+	export = SqliteExport(db, args.output)
+	try:
+		counts = export.export()
+	except:
+		# Half an export is of no use
+		export.close()
+		os.remove(args.output)
+		raise
+	export.close()
+	log.warning('Exported '+', '.join(str(counts.get(table, 0))+' '+table for table in ['modules', 'contacts', 'settings', 'events']))
+
+def compact(db, args):
+	if os.path.abspath(args.output) == os.path.abspath(args.dbname):
+		raise Exception("Cannot compact the database into itself")
+	map = db.compact(args.output)
+	log.warning('Compacted '+str(db.header.ofsFileEnd)+' bytes into '+str(os.path.getsize(args.output)))
+	if args.offset_map:
+		with open(args.offset_map, 'w') as file:
+			for offset in sorted(map.keys()):
+				file.write(str(offset)+' '+str(map[offset])+'\n')
 
 if __name__ == "__main__":
 	sys.exit(main())
@@ -8,6 +8,9 @@ import utfutils
 import fnmatch
 import __builtin__
 import copy
+import struct
+from collections import deque
+import hashlib
 
 log = logging.getLogger('mirdiff')
 
@@ -50,19 +53,29 @@ def contact_by_id(contacts, id):
 			return contact
 	return None
 
+# contactID -> contact for a list of contacts (first one wins)
+def contacts_by_id(contacts):
+	ret = {}
+	for contact in contacts:
+		ret.setdefault(contact.contactID, contact)
+	return ret
+
 # Returns a dict with matched, missing and new contacts
 def compare_contact_lists(contacts1 = None, contacts2 = None):
 	ret = {}
 	ret['match'] = []					# A list of (contact1, contact2) pairs
-	ret['missing1'] = contacts1[:]		# Missing from contacts1
-	ret['missing2'] = contacts2[:]		# Missing from contacts2
-	missing_contact1 = []
+	ret['missing1'] = []				# Missing from contacts1
+	ret['missing2'] = []				# Missing from contacts2
+	index2 = contacts_by_id(contacts2)
+	matched2 = set()
 	for contact1 in contacts1:
-		contact2 = contact_by_id(contacts2, contact1.contactID)
+		contact2 = index2.get(contact1.contactID, None)
 		if contact2 <> None:
 			ret['match'].append((contact1, contact2))
-			ret['missing1'].remove(contact1)
-			ret['missing2'].remove(contact2)
+			matched2.add(id(contact2))
+		else:
+			ret['missing1'].append(contact1)
+	ret['missing2'] = [contact2 for contact2 in contacts2 if not id(contact2) in matched2]
 	return ret
 
 # Maps DBContacts from list1 to DBContacts from list2:
@@ -77,11 +90,13 @@ def map_contacts(list1, list2):
 		list2 = list2.get_contacts()[:]
 	ret = {}
 	ret[None] = []
+	index2 = contacts_by_id(list2)
 	for contact1 in list1:
-		contact2 = contact_by_id(list2, contact1.contactID)
+		contact2 = index2.get(contact1.contactID, None)
 		ret[contact1] = contact2
+	matched2 = set(id(contact2) for contact2 in ret.values())
 	for contact2 in list2:
-		if not contact2 in ret.values():
+		if not id(contact2) in matched2:
 			ret[None].append(contact2)
 	return ret
 
@@ -140,38 +155,89 @@ class EventDiff:
 # Returns EventDiff
 def compare_event_lists(db1, db2, el1, el2):
 	diff = EventDiff(both=[], db1=[])
-	diff.db2 = el2[:]	# Start with all of them as new
+	remaining2 = EventFingerprints(db2, el2)	# Start with all of them as new
+	both = EventFingerprints(db2)
 	for e1 in el1:
-		e2 = compare_find_event(db1, db2, e1, diff.db2)
-		if e2 <> None:
-			diff.db2.remove(e2)
+		pos = remaining2.find(db1, e1)
+		if pos <> None:
+			e2 = remaining2.remove(pos)
 		else:
 			# Try in already matched e2 events. Some events are exact duplicates, we forgive if those go missing.
-			e2 = compare_find_event(db1, db2, e1, diff.both)
+			pos = both.find(db1, e1)
+			e2 = both.events[pos] if pos <> None else None
 		if e2 == None:
 			diff.db1.append(e1)
 		else:
-			diff.both.append(e2)
+			both.append(e2)
+	diff.both = both.events
+	diff.db2 = remaining2.remaining()
 	# Scan e2 remainder for exact duplicates on e1
-	for e2 in diff.db2[:]:
-		e1 = compare_find_event(db2, db1, e2, el1)	# in untocuhed el1 because we allow duplicates
-		if e1 <> None:
-			diff.db2.remove(e2)
+	all1 = EventFingerprints(db1, el1)	# untouched el1 because we allow duplicates
+	remaining2 = []
+	for e2 in diff.db2:
+		if all1.find(db2, e2) <> None:
 			diff.both.append(e2)
+		else:
+			remaining2.append(e2)
+	diff.db2 = remaining2
 	return diff
 
-# Locates the event e1 from db1 in the list of events el2 from db2
-def compare_find_event(db1, db2, e1, el2):
-	f_candidates = []
-	for e2 in el2:
-		fail = compare_events(db1, db2, e1, e2)
-		if fail == "":
-			return e2
-		if fail == "f":
-			f_candidates.append(e2)
-	if len(f_candidates) > 0:
-		return f_candidates[0]
-	return None
+# Event list indexed by comparison fingerprints, to find matches without comparing to every event.
+# compare_events() returns "" or "f" for two events exactly when they share a loose key, and ""
+# when they share an exact key. The keys are (contactID, module name, type, flags, text or blob), with
+# all the flags (exact) or only the permanent ones (loose). Events which have decoded text get keys
+# for both, as either matching is enough.
+class EventFingerprints:
+	def __init__(self, db, events=[]):
+		self.db = db
+		self.events = []
+		self.removed = []
+		self.buckets = {}	# key -> deque of positions in self.events, in order
+		for event in events:
+			self.append(event)
+
+	@staticmethod
+	def keys(db, event):
+		base = (event.contactID, db.get_module_name(event.ofsModuleName), event.eventType)
+		permanent = event.flags & (event.DBEF_SENT+event.DBEF_RTL)
+		contents = [('b', event.blob)]
+		if hasattr(event, 'data') and hasattr(event.data, 'text'):
+			contents.append(('t', event.data.text))
+		return ([('=', base, event.flags, content) for content in contents],
+			[('~', base, permanent, content) for content in contents])
+
+	def append(self, event):
+		pos = len(self.events)
+		self.events.append(event)
+		self.removed.append(False)
+		(exact, loose) = self.keys(self.db, event)
+		for key in exact + loose:
+			self.buckets.setdefault(key, deque()).append(pos)
+
+	def remove(self, pos):
+		self.removed[pos] = True
+		return self.events[pos]
+
+	# Returns the events which haven't been removed, in order
+	def remaining(self):
+		return [event for (event, removed) in zip(self.events, self.removed) if not removed]
+
+	# Returns the position of the first event matching the given one (from the given db) exactly,
+	# or else the first one which differs only by temporary flags, or None
+	def find(self, db, event):
+		for keys in self.keys(db, event):
+			found = None
+			for key in keys:
+				bucket = self.buckets.get(key, None)
+				if bucket == None:
+					continue
+				while bucket and self.removed[bucket[0]]:
+					bucket.popleft()
+				if bucket and ((found == None) or (bucket[0] < found)):
+					found = bucket[0]
+			if found <> None:
+				return found
+		return None
 
 
 # Given two event iterators, compares them timestamp-by-timestamp and produces EventDiff()s for each timestamp
@@ -235,37 +301,45 @@ def compare_contact_events(db1, db2, contact1, contact2):
 # We want to insert new events after the LAST EVENT FOR THEIR TIMESTAMP
 # The event chain might contain events for other contacts which we haven't even considered:
 #    c1@10 -> c1@10 -> c2@10 -> [want to insert here] -> c1@11
-# We have to start with any event with the timestamp <= required, and scan forward
-def find_event_insert_point(db, contact, timestamp, start_event):
-	if start_event == None:
-		if contact.ofsFirstEvent == 0:
-			return None
-		start_event = db.read_event(contact.ofsFirstEvent)
-	while start_event.ofsNext > 0:
-		next_event = db.read_event(start_event.ofsNext)
-		if next_event.timestamp >= timestamp:
-			break
-		start_event = next_event
-	return start_event
-
-# Imports event evt1 from foreign DB1 to DB2. Returns its offset.
-def import_event(db1, db2, evt1, insert_after):
+# Returns the last event in the chain with the timestamp < given, or None to insert at the start.
+# start_event is not needed anymore, the chain's timestamp index is used instead.
+def find_event_insert_point(db, contact, timestamp, start_event=None):
+	offset = db.get_event_index(contact).last_before(timestamp)
+	return db.read_event_header(offset) if offset <> 0 else None
+
+# Converts event evt1 from foreign DB1 to a new DB2 event
+def convert_event(db1, db2, evt1):
+	evt2 = copy.copy(evt1)
 	# Determine target contact ID
 	# We would have to map event.contactID -> new_event.contactID,
 	# but thankfully we *match* contacts by IDs atm so they are by definition equal
-	db2_contactID = evt1.contactID
-	# The event needs to be inserted to the host contact which may be a different one
-	host_contact = db2.get_host_contact(db2_contactID)
-	# Find insertion point
-	insert_after = find_event_insert_point(db2, host_contact, evt1.timestamp+1, insert_after)
-	# Convert DB1 event to DB2 event
-	evt2 = copy.copy(evt1)
-	evt2.contactID = db2_contactID
+	evt2.contactID = evt1.contactID
 	# Module's offset might've changed - this happens in the wild
 	# Note: Preserve the original event module name, even if the contact protocol have changed
 	evt2.ofsModuleName = db2.find_module_name(db1.get_module_name(evt1.ofsModuleName))
 	assert(evt2.ofsModuleName <> None)
+	return evt2
+
+# Imports event evt1 from foreign DB1 to DB2. Returns its offset.
+def import_event(db1, db2, evt1, insert_after):
+	evt2 = convert_event(db1, db2, evt1)
+	# The event needs to be inserted to the host contact which may be a different one
+	host_contact = db2.get_host_contact(evt2.contactID)
+	# Find insertion point
+	insert_after = find_event_insert_point(db2, host_contact, evt2.timestamp+1)
 	return db2.add_event(evt2, host_contact, insert_after=insert_after)
+
+# Imports many events from DB1 to DB2, one chain splice per host contact. Returns their offsets.
+def import_events(db1, db2, events1):
+	hosts = {}	# host contactID -> [DB2 events], keeping the order
+	for evt1 in events1:
+		evt2 = convert_event(db1, db2, evt1)
+		hosts.setdefault(db2.get_host_contact(evt2.contactID).contactID, []).append(evt2)
+	offsets = []
+	for (hostId, events2) in hosts.items():
+		events2.sort(key=lambda event: event.timestamp)	# stable
+		offsets += db2.add_events(events2, db2.contact_by_id(hostId))
+	return offsets
 	
 
 def print_event_diff(db1, db2, diff):
@@ -281,10 +355,10 @@ def print_event_diff(db1, db2, diff):
 def compare_contact_events_print(db1, db2, contact1, contact2, merge=False):
 	print ("Comparing "+contact1.display_name+" (#"+str(contact1.contactID)+")"
 		+" and "+contact2.display_name+" (#"+str(contact2.contactID)+")...")
-	last_db2_event = None	# Keep track to quickly insert new ones
+	if (prefilter <> None) and prefilter.unchanged(contact1, contact2):
+		return
+	imports = []	# DB1 events to merge, all at once when the comparison is over
 	for diff in EventDiffIterator(db1, db2, db1.get_events(contact1), db2.get_events(contact2)):
-		if diff.both: last_db2_event = diff.both[-1]
-		elif diff.db2: last_db2_event = diff.db2[-1]
 		if (not diff.db1) and (not diff.db2):
 			continue
 		if (diff.db1 == None) and not args.process_new:
@@ -292,9 +366,213 @@ def compare_contact_events_print(db1, db2, contact1, contact2, merge=False):
 		if diff.db2 == None: diff.db2 = []	# we don't care about particulars with DB2
 		print_event_diff(db1, db2, diff)
 		if merge and (diff.db1 <> None):
-			for evt1 in diff.db1:
-				last_db2_event = import_event(db1, db2, evt1, last_db2_event)
+			imports += diff.db1
+		print ""	# Empty line
+	if imports:
+		import_events(db1, db2, imports)
+
+def compare_events_print(db1, db2, pairs, merge=False):
+	for (contact1, contact2) in pairs:
+		compare_contact_events_print(db1, db2, contact1, contact2, merge=merge)
+
+
+"""
+Settings
+Most modules don't change between snapshots, so the blobs are compared by hash first
+and only the ones that differ are parsed down to individual settings.
+"""
+# Returns {lowercase moduleName -> (blob hash, DBContactSettings)} for the contact
+def settings_hashes(db, contact):
+	ret = {}
+	for offset in db.contact_settings_offsets(contact):
+		settings = db.read_settings_header(offset)
+		ret[settings.moduleName.lower()] = (hashlib.md5(settings.blob).digest(), settings)
+	return ret
+
+# Compares two module settings blobs, any of which may be None.
+# Returns a list of (DB1 setting, its bytes, DB2 setting), with None for the missing setting.
+def compare_module_settings(settings1, settings2):
+	entries1 = settings1.entries() if settings1 <> None else []
+	entries2 = settings2.entries() if settings2 <> None else []
+	index2 = dict((setting.name.lower(), (setting, data)) for (setting, data) in entries2)
+	ret = []
+	for (setting1, data1) in entries1:
+		(setting2, data2) = index2.pop(setting1.name.lower(), (None, None))
+		# Compare everything past the name, its case does not matter
+		if (setting2 == None) or (data1[ord(data1[0])+1:] <> data2[ord(data2[0])+1:]):
+			ret.append((setting1, data1, setting2))
+	for (setting2, data2) in entries2:
+		if setting2.name.lower() in index2:
+			ret.append((None, None, setting2))
+	return ret
+
+# Imports settings missing from the DB2 module from DB1
+def import_module_settings(db1, db2, contact2, settings1, settings2, missing):
+	blob = ''.join(data for (setting1, data) in missing)
+	if settings2 <> None:
+		blob = ''.join(data for (setting2, data) in settings2.entries()) + blob
+		db2.write_contact_settings(contact2, settings2, blob)
+		return
+	ofsModuleName = db2.find_module_name(settings1.moduleName)
+	if ofsModuleName == None:
+		ofsModuleName = db2.add_module_name(settings1.moduleName)
+	db2.add_contact_settings(contact2, ofsModuleName, blob)
+
+# Compares the settings of two contacts, module by module
+def compare_contact_settings_print(db1, db2, contact1, contact2, merge=False):
+	hashes1 = settings_hashes(db1, contact1)
+	hashes2 = settings_hashes(db2, contact2)
+	header = ("Comparing "+contact1.display_name+" (#"+str(contact1.contactID)+")"
+		+" and "+contact2.display_name+" (#"+str(contact2.contactID)+")...")
+	imports = []	# (DB1 module settings, DB2 module settings, [DB1 settings missing from DB2])
+	for moduleName in sorted(set(hashes1.keys()) | set(hashes2.keys())):
+		(hash1, settings1) = hashes1.get(moduleName, (None, None))
+		(hash2, settings2) = hashes2.get(moduleName, (None, None))
+		if hash1 == hash2:
+			continue
+		missing = []
+		for (setting1, data1, setting2) in compare_module_settings(settings1, settings2):
+			if header <> None:
+				print header
+				header = None
+			if setting1 == None:
+				print "++DB2: "+settings2.moduleName+"\\"+unicode(setting2)
+			elif setting2 == None:
+				print "--DB2: "+settings1.moduleName+"\\"+unicode(setting1)
+				missing.append((setting1, data1))
+			else:
+				print "!=DB1: "+settings1.moduleName+"\\"+unicode(setting1)
+				print "!=DB2: "+settings2.moduleName+"\\"+unicode(setting2)
+		if missing:
+			imports.append((settings1, settings2, missing))
+	if header == None:
 		print ""	# Empty line
+	if merge:
+		for (settings1, settings2, missing) in imports:
+			import_module_settings(db1, db2, contact2, settings1, settings2, missing)
+
+def compare_settings_print(db1, db2, pairs, merge=False):
+	for (contact1, contact2) in pairs:
+		compare_contact_settings_print(db1, db2, contact1, contact2, merge=merge)
+
+
+"""
+Prefilter
+Between two snapshots most contacts don't change at all, and it's cheaper to prove that than to decode
+and compare all of their events.
+"""
+# Hashes of fixed-size file regions, computed on first use.
+# Snapshots which share byte layout have equal hashes for the regions nobody has written to.
+class RegionHashes:
+	REGION_SIZE = 1024*1024
+	def __init__(self, db):
+		self.db = db
+		self.hashes = {}	# region number -> digest
+	
+	def get(self, region):
+		digest = self.hashes.get(region, None)
+		if digest == None:
+			offset = region * self.REGION_SIZE
+			if self.db.mm <> None:
+				data = buffer(self.db.mm, offset, self.REGION_SIZE)
+			else:
+				self.db.file.seek(offset)
+				data = self.db.file.read(self.REGION_SIZE)
+			digest = hashlib.md5(data).digest()
+			self.hashes[region] = digest
+		return digest
+	
+	def regions(self, offset, size):
+		return xrange(offset // self.REGION_SIZE, (offset + max(size, 1) - 1) // self.REGION_SIZE + 1)
+
+# Tells contacts with the same events in both snapshots, so that comparing them can be skipped:
+#  1. Quick fingerprint: event counts and the last timestamps must match, or the contact has changed.
+#  2. If the chains are at the same offsets, and all file regions holding their events are the same,
+#     the events are the same too.
+#  3. Otherwise, hash the events of both (all header fields except the offsets, module name and blob).
+# Both checks cover the whole chain of the hosting contact: with MetaContacts, editing one child
+# relinks the events of another, and the new events may land in regions the child's own never touch.
+class EventPrefilter:
+	def __init__(self, db1, db2):
+		self.db1 = db1
+		self.db2 = db2
+		self.regions1 = RegionHashes(db1)
+		self.regions2 = RegionHashes(db2)
+		self.sameChains = {}	# host offset in DB1 -> all regions of its chain are the same
+		self.chainHashes = {}	# (is DB2, host offset) -> events_hash() digest
+		self.skipped = 0
+	
+	# The contact whose chain get_events() reads
+	@staticmethod
+	def events_host(db, contact):
+		if (contact.ofsFirstEvent == 0) and (contact.eventCount > 0):
+			return db.get_meta_contact(contact) or contact
+		return contact
+	
+	def fingerprint(self, db, contact):
+		host = self.events_host(db, contact)
+		lastTimestamp = db.read_event_header(host.ofsLastEvent).timestamp if host.ofsLastEvent <> 0 else 0
+		return (contact.eventCount, host.contactID, host.eventCount, lastTimestamp)
+	
+	# Chain layout, which must be the same for the region check to make sense
+	def layout(self, db, contact):
+		host = self.events_host(db, contact)
+		return (contact.offset, contact.ofsFirstEvent, contact.ofsLastEvent, contact.protocol,
+			host.offset, host.ofsFirstEvent, host.ofsLastEvent)
+	
+	def unchanged(self, contact1, contact2):
+		if self.fingerprint(self.db1, contact1) <> self.fingerprint(self.db2, contact2):
+			return False
+		if self.same_regions(contact1, contact2) or (self.events_hash(self.db1, contact1) == self.events_hash(self.db2, contact2)):
+			self.skipped += 1
+			return True
+		return False
+	
+	# If all bytes the chain walk reads are the same in both files, so are the events
+	def same_regions(self, contact1, contact2):
+		# Writes to DB2 are not in the region hashes (batched writes also set modified)
+		if self.db2.modified:
+			return False
+		if self.layout(self.db1, contact1) <> self.layout(self.db2, contact2):
+			return False
+		# All children of a MetaContact share the result
+		host1 = self.events_host(self.db1, contact1)
+		same = self.sameChains.get(host1.offset, None)
+		if same == None:
+			same = self.same_chain_regions(host1)
+			self.sameChains[host1.offset] = same
+		return same
+	
+	def same_chain_regions(self, host1):
+		modules = set()
+		for event in self.db1.get_event_iter(host1, None, self.db1.EVENT_HEADER):
+			for region in self.regions1.regions(event.offset, event.size()):
+				if self.regions1.get(region) <> self.regions2.get(region):
+					return False
+			modules.add(event.ofsModuleName)
+		for ofsModuleName in modules:
+			if self.db1.get_module_name(ofsModuleName) <> self.db2.get_module_name(ofsModuleName):
+				return False
+		return True
+	
+	def events_hash(self, db, contact):
+		host = self.events_host(db, contact)
+		# Merging into DB2 changes its chains as we go
+		key = (db is self.db2, host.offset)
+		digest = self.chainHashes.get(key, None) if not db.modified else None
+		if digest <> None:
+			return digest
+		hash = hashlib.md5()
+		for event in db.get_event_iter(host, None, db.EVENT_BLOB):
+			hash.update(struct.pack('=IIIHI', event.contactID, event.timestamp, event.flags, event.eventType, event.cbBlob))
+			hash.update(db.get_module_name(event.ofsModuleName).encode('ascii') + '\0')
+			hash.update(event.blob_view())
+		digest = hash.digest()
+		if not db.modified:
+			self.chainHashes[key] = digest
+		return digest
+
+prefilter = None	# EventPrefilter, see main()
 
 
 """
@@ -306,26 +584,31 @@ def main():
 	parser.add_argument("dbname1", help='path to older database file')
 	parser.add_argument("dbname2", help='path to newer database file')
 	parser.add_argument("--write", help='opens the databases for writing (WARNING: enables editing functions!)', action='store_true')
+	parser.add_argument("--mmap", help='maps the databases into memory and decodes them in place (faster with large databases)', action='store_true')
+	parser.add_argument("--index", help='keeps sidecar indexes next to the databases (dbname.idx) for faster reopening', action='store_true')
 	parser.add_argument("--contact", type=str, nargs='*', help='diff only this contact')
 	parser.add_argument("--modules", action='store_true', help='diff/merge modules')
 	parser.add_argument("--contacts", action='store_true', help='diff/merge contacts')
 	parser.add_argument("--events", action='store_true', help='diff/merge events')
+	parser.add_argument("--settings", action='store_true', help='diff/merge contact settings')
 	
 	parser.add_argument("--process-new", help='process NEW events in addition to changed or missing events', action='store_true')
 	parser.add_argument("--merge-modules", action='store_true', help='imports all missing modules from DB1 into DB2')
 	parser.add_argument("--merge-events", action='store_true', help='imports all missing messages from DB1 into DB2')
+	parser.add_argument("--merge-settings", action='store_true', help='imports all missing settings from DB1 into DB2 (changed ones are kept as they are in DB2)')
+	parser.add_argument("--no-prefilter", action='store_true', help='compare all events of all contacts, even those which look unchanged')
 	global args
 	args = parser.parse_args()
 	coreutils.init(args)
 
 	# If nothing is specified, assume default set of diffs
-	if not (args.modules or args.contacts or args.events):
+	if not (args.modules or args.contacts or args.events or args.settings):
 		args.modules = True
 		args.contacts = True
 		args.events = True
 
-	db1 = mirandadb.MirandaDbxMmap(args.dbname1)
-	db2 = mirandadb.MirandaDbxMmap(args.dbname2, writeable=args.write)
+	db1 = mirandadb.MirandaDbxMmap(args.dbname1, use_mmap=args.mmap, use_index=args.index)
+	db2 = mirandadb.MirandaDbxMmap(args.dbname2, writeable=args.write, use_mmap=args.mmap, use_index=args.index)
 
 	global modules_map
 	modules_map = map_modules(db1, db2)
@@ -344,11 +627,34 @@ def main():
 		for contact2 in contacts_map['missing2']:
 			print "++DB2: "+contact2.display_name+' (#'+str(contact2.contactID)+')'
 
+	pairs = list(contacts_map['match'])
+	if not args.contact: # explicitly compare one db.user against another
+		pairs.insert(0, (db1.user, db2.user))
+
+	# Merging is lots of small writes, so they are batched. Reads inside a batch go through it
+	# and not the mmap, so plain diffs go without one.
+	global prefilter
+	prefilter = EventPrefilter(db1, db2) if not args.no_prefilter else None
 	if args.events:
-		if not args.contact: # explicitly compare one db.user against another
-			compare_contact_events_print(db1, db2, db1.user, db2.user, merge=args.merge_events)
-		for (contact1, contact2) in contacts_map['match']:
-			compare_contact_events_print(db1, db2, contact1, contact2, merge=args.merge_events)
+		if args.merge_events:
+			with db2.batch():
+				compare_events_print(db1, db2, pairs, merge=True)
+		else:
+			compare_events_print(db1, db2, pairs)
+		if prefilter <> None:
+			log.info("Skipped "+str(prefilter.skipped)+" unchanged contacts")
+
+	if args.settings:
+		print "Settings:"
+		if args.merge_settings:
+			with db2.batch():
+				compare_settings_print(db1, db2, pairs, merge=True)
+		else:
+			compare_settings_print(db1, db2, pairs)
+
+	if args.index:
+		db1.update_index()
+		db2.update_index()
 
 if __name__ == "__main__":
 	sys.exit(main())
@@ -7,18 +7,28 @@ import mirandadb
 import mirdiff
 import utfutils
 import fnmatch
+import re
+import struct
+import mmap
+import bisect
+from collections import Counter
+from array import array
 
 log = logging.getLogger('mirrestore')
 
 # Enhances MirandaDbxMmap with some data scan/restore capabilities
 class MirandaDbxMmapChk(mirandadb.MirandaDbxMmap):
+	utf16_verdicts = {}		# text -> utf16test() verdict, see test_utf16_texts()
+	
 	def utf8trydecode(self, data):
 		ret = super(MirandaDbxMmapChk, self).utf8trydecode(data)
 		if hasattr(ret, 'problem'):
 			return ret
 		
 		# Verify that the text looks like valid UTF16 after decoding
-		test = utfutils.utf16test(ret.text)
+		test = self.utf16_verdicts.get(ret.text, None)
+		if test == None:
+			test = utfutils.utf16test(ret.text)
 		if test == True:
 			return ret
 		ret.problem = test
@@ -27,69 +37,138 @@ class MirandaDbxMmapChk(mirandadb.MirandaDbxMmap):
 		ret.utf16 = text_bytes.encode('hex')
 		ret.text = None # remove text to indicate problems
 		return ret
+	
+	# Tests the UTF-8 texts of these events all at once, for utf8trydecode() to look up when decoding them
+	def test_utf16_texts(self, events):
+		texts = []
+		for event in events:
+			if event.flags & event.DBEF_UTF:
+				try:
+					texts.append(utfutils.eatutf8(event.blob)[0].decode('utf-8'))
+				except UnicodeDecodeError:
+					pass
+		self.utf16_verdicts = dict(zip(texts, utfutils.utf16test_all(texts)))
 
 def dump_events(args):
-	db = MirandaDbxMmapChk(args.dbname)
+	db = MirandaDbxMmapChk(args.dbname, use_mmap=args.mmap, use_index=args.index)
 	bad_event_count = 0
 	bad_offsets = {}
-	for contact in mirandadb.select_contacts_opt(db, args.contact):
-		print "Events for "+contact.display_name+": "
-		for event in db.get_events(contact):
-			data = event.data
-			if hasattr(data, 'problem'):
-				bad_event_count += 1
-			if args.bad and not hasattr(data, 'problem'):
-				continue
-			if args.bad_offsets:
-				data.offset = event.offset
-				bad_offset = event.offset // 0x10000
-				if bad_offset in bad_offsets:
-					bad_offsets[bad_offset] += 1
-				else:
-					bad_offsets[bad_offset] = 1
-			print mirandadb.format_event(db, event, data)
+	contacts = mirandadb.select_contacts_opt(db, args.contact)
+	for (lines, contact_bad_count, contact_bad_offsets) in mirandadb.parallel_map(db, dump_events_contact, contacts, args.jobs, (args.bad, args.bad_offsets)):
+		for line in lines:
+			print line
+		bad_event_count += contact_bad_count
+		for (bad_offset, count) in contact_bad_offsets.items():
+			bad_offsets[bad_offset] = bad_offsets.get(bad_offset, 0) + count
 	log.warning("Bad events: "+str(bad_event_count))
 	print "Bad events:"+str(bad_event_count)
 	if args.bad_offsets:
 		print "Bad offsets:"
 		print '\n'.join([ repr(key) + ': ' + repr(value) for (key, value) in bad_offsets.items()])
+	if args.index:
+		db.update_index()
+
+# Events are read and their texts checked for junk this many at once
+DUMP_EVENTS_BATCH = 1000
+
+# Returns the lines to print for the contact, the number of bad events and {offset // 0x10000 -> event count}
+def dump_events_contact(db, contact, bad, with_bad_offsets):
+	lines = ["Events for "+contact.display_name+": "]
+	bad_event_count = 0
+	bad_offsets = {}
+	for event in dump_events_decode(db, db.get_events(contact, projection=db.EVENT_BLOB)):
+		data = event.data
+		if hasattr(data, 'problem'):
+			bad_event_count += 1
+		if bad and not hasattr(data, 'problem'):
+			continue
+		if with_bad_offsets:
+			data.offset = event.offset
+			bad_offset = event.offset // 0x10000
+			if bad_offset in bad_offsets:
+				bad_offsets[bad_offset] += 1
+			else:
+				bad_offsets[bad_offset] = 1
+		lines.append(mirandadb.format_event(db, event, data))
+	return (lines, bad_event_count, bad_offsets)
+
+# Decodes the events in batches, see MirandaDbxMmapChk.test_utf16_texts()
+def dump_events_decode(db, events):
+	batch = []
+	for event in events:
+		batch.append(event)
+		if len(batch) >= DUMP_EVENTS_BATCH:
+			for event in dump_events_decode_batch(db, batch):
+				yield event
+			batch = []
+	for event in dump_events_decode_batch(db, batch):
+		yield event
+
+def dump_events_decode_batch(db, events):
+	db.test_utf16_texts(events)
+	for event in events:
+		event.data = db.decode_event_data(event)
+	db.utf16_verdicts = {}
+	return events
 
 
 """
 Verifies the database integrity
 """
+_warnings = None		# if set, vassert() collects the messages here instead of printing them
+
 def vassert(condition, message):
 	if not condition:
-		print "WARNING: "+message
+		if _warnings <> None:
+			_warnings.append(message)
+		else:
+			print "WARNING: "+message
 
 class DbVerifier(mirandadb.MirandaDbxMmap):
-	def __init__(self, filename):
-		super(DbVerifier, self).__init__(filename)
+	def __init__(self, filename, use_mmap=False):
+		super(DbVerifier, self).__init__(filename, use_mmap=use_mmap)
 		self.init_mem()
 		self.use_memmap = False
 		self.contactIDs = {}
+		self.metaEventCounts = {}	# meta contactID -> Counter({contactID: events in the meta's chain})
 	
+	# With use_memmap, every registered struct is kept as (offset, size) in two arrays, and the overlaps
+	# are found once everything is collected, see check_mem()
 	def init_mem(self):
 		self.totalUsed = 0
-		self.mem_map = []
+		self.memOffsets = array('I')
+		self.memSizes = array('I')
 	
 	def reg_mem(self, struct, size = None):
 		if size == None:
 			size = struct.size()
-		offset = struct.offset
 		self.totalUsed += size
 		if not self.use_memmap: return
-		i = 0
-		while i < len(self.mem_map):
-			pair = self.mem_map[i]
-			if pair[0] < offset:
-				vassert(pair[0] + pair[1] <= offset, "Struct "+str(offset)+'~'+str(size)+' conflicts with struct '+str(pair[0])+'~'+str(pair[1]))
-				break
-			i += 1
-		pair = (offset, size)
-		self.mem_map.insert(i, pair)
+		self.memOffsets.append(struct.offset)
+		self.memSizes.append(size)
+	
+	# Sorts the registered structs by offset and sweeps them once, reporting overlaps.
+	# Returns the list of gaps (offset, size) not covered by any struct, up to ofsFileEnd.
+	def check_mem(self):
+		order = sorted(xrange(len(self.memOffsets)), key=self.memOffsets.__getitem__)
+		gaps = []
+		(lastOffset, lastSize) = (0, 0)		# the struct reaching the furthest so far
+		end = 0
+		for i in order:
+			(offset, size) = (self.memOffsets[i], self.memSizes[i])
+			if offset < end:
+				vassert(False, "Struct "+str(offset)+'~'+str(size)+' conflicts with struct '+str(lastOffset)+'~'+str(lastSize))
+			elif offset > end:
+				gaps.append((end, offset - end))
+			if offset + size > end:
+				(lastOffset, lastSize) = (offset, size)
+				end = offset + size
+		if end < self.header.ofsFileEnd:
+			gaps.append((end, self.header.ofsFileEnd - end))
+		return gaps
 	
-	def verify(self):
+	#   jobs: verify the contacts in this many processes, see mirandadb.parallel_map()
+	def verify(self, jobs=1):
 		self.init_mem()
 		header = self.header
 		self.reg_mem(header)
@@ -103,7 +182,7 @@ class DbVerifier(mirandadb.MirandaDbxMmap):
 		self.scan_modules()
 	
 		# Contacts
-		self.verify_contacts()
+		self.verify_contacts(jobs)
 		
 		self.file.seek(0, 2)
 		self.fileSize = self.file.tell()
@@ -111,7 +190,10 @@ class DbVerifier(mirandadb.MirandaDbxMmap):
 		vassert(sizeDiff == 0,
 			'ofsFileEnd:'+str(self.header.ofsFileEnd)+' - TotalUsed:'+str(self.totalUsed)+' != SlackSpace:'+str(self.header.slackSpace)+' (diff='+str(sizeDiff)+')'
 			)
+		
+		self.gaps = self.check_mem() if self.use_memmap else None
 	
+	moduleOffsets = None
 	def scan_modules(self):
 		offset = self.header.ofsModuleNames
 		self.moduleOffsets = []
@@ -121,28 +203,58 @@ class DbVerifier(mirandadb.MirandaDbxMmap):
 			offset = module.ofsNext
 			self.reg_mem(module)
 	
-	def verify_contacts(self):
+	def verify_contacts(self, jobs=1):
 		contactCount = 0
 		self.contactIDs = {}
 		
-		self.verify_contact(self.read_contact(self.header.ofsUser))
+		if jobs <> 1:
+			self.verify_contacts_parallel(jobs)
+			return
+		
+		self.verify_contact_id(self.read_contact(self.header.ofsUser))
 		
 		offset = self.header.ofsFirstContact
 		while offset <> 0:
 			contact = self.read_contact(offset)
 			offset = contact.ofsNext
 			contactCount += 1
-			self.verify_contact(contact)
+			self.verify_contact_id(contact)
+		vassert(contactCount == self.header.contactCount, 'header.contactCount ('+str(self.header.contactCount)+') doesn\'t match actual count ('+str(contactCount)+')')
+	
+	# Workers verify the contacts and return what they've found, which is merged here in the contact order,
+	# so the warnings and the memory map come out the same as with a single process
+	def verify_contacts_parallel(self, jobs):
+		contacts = [self.read_contact(self.header.ofsUser)]
+		offset = self.header.ofsFirstContact
+		while offset <> 0:
+			contact = self.read_contact(offset)
+			offset = contact.ofsNext
+			contacts.append(contact)
+		results = mirandadb.parallel_map(self, verify_contact_part, contacts, jobs, (self.use_memmap,))
+		for (contact, (totalUsed, memOffsets, memSizes, warnings)) in zip(contacts, results):
+			self.check_contact_id(contact)
+			self.totalUsed += totalUsed
+			self.memOffsets.extend(memOffsets)
+			self.memSizes.extend(memSizes)
+			for message in warnings:
+				vassert(False, message)
+		contactCount = len(contacts) - 1
 		vassert(contactCount == self.header.contactCount, 'header.contactCount ('+str(self.header.contactCount)+') doesn\'t match actual count ('+str(contactCount)+')')
 	
+	# Duplicate IDs
+	def check_contact_id(self, contact):
+		vassert(not(contact.contactID in self.contactIDs), 'Contact #'+str(contact.contactID)+': Duplicate contact ID')
+		self.contactIDs[contact.contactID] = True
+	
+	def verify_contact_id(self, contact):
+		self.check_contact_id(contact)
+		self.verify_contact(contact)
+	
+	# Verifies everything about the contact except that its ID is unique
 	def verify_contact(self, contact):
 		self.reg_mem(contact)
 		prefix = 'Contact #'+str(contact.contactID)+': '
 		
-		# Duplicate IDs
-		vassert(not(contact.contactID in self.contactIDs), prefix+'Duplicate contact ID')
-		self.contactIDs[contact.contactID] = True
-		
 		self.verify_settings(contact.ofsFirstSettings)
 		
 		self.expand_contact(contact)
@@ -176,34 +288,38 @@ class DbVerifier(mirandadb.MirandaDbxMmap):
 				child1_parent = child1.get_meta_parent()
 				vassert(child1_parent==contact.contactID, prefix+'Child '+str(childId)+' doesn\'t consider us parent (has '+str(child1_parent)+' instead)')
 
-		(eventCount, ofsLastEvent) = self.verify_event_chain(contact.ofsFirstEvent, allowed_ids)
+		(eventCount, ofsLastEvent, idCounts) = self.verify_event_chain(contact.ofsFirstEvent, allowed_ids)
+		if is_meta:
+			self.metaEventCounts[contact.contactID] = idCounts
 		
 		vassert(contact.ofsLastEvent == ofsLastEvent, prefix+"ofsLastEvent doesn\'t match ("+str(contact.ofsLastEvent)+' given, '+str(ofsLastEvent)+' found)')
 		# Allow actual eventCount to match EXACTLY 0 if this is a meta-child + parent has corrent number of our events
 		if (meta1_id == None) or (eventCount <> 0):
 			vassert(contact.eventCount == eventCount, prefix+"eventCount doesn\'t match ("+str(contact.eventCount)+' given, '+str(eventCount)+' actual)')
 		else:
-			eventCount = self.count_events(meta1.ofsFirstEvent, contact.contactID)
+			eventCount = self.meta_event_counts(meta1)[contact.contactID]
 			vassert(contact.eventCount == eventCount, prefix+"eventCount doesn\'t match ("+str(contact.eventCount)+' given, '+str(eventCount)+' actual, stored in meta parent)')
 	
 	def verify_settings(self, offset):
 		while offset <> 0:
 			module = self.read(mirandadb.DBContactSettings(), offset)
-			self.reg_mem(module)
+			self.reg_mem(module, module.size() + module.cbBlob)	# size() is only the fixed part
 			prefix = "Settings block "+str(offset)
 			
 			vassert(module.ofsModuleName in self.moduleOffsets, prefix+': ofsModuleName '+str(module.ofsModuleName)+' doesn\'t match any of the known modules')
 			offset = module.ofsNext
 	
+	# Returns (event count, last event offset, Counter({contactID: event count}))
 	def verify_event_chain(self, offset, allowed_ids):
 		eventCount = 0
 		lastOffset = 0
 		lastTimestamp = 0
-		while offset <> 0:
+		idCounts = Counter()
+		for event in self.scan_events(offset, header_only=True):
 			eventCount += 1
-			event = self.read_event(offset)
+			idCounts[event.contactID] += 1
 			self.reg_mem(event)
-			prefix = "Event "+str(offset)
+			prefix = "Event "+str(event.offset)
 			
 			vassert(event.ofsPrev == lastOffset, prefix+': ofsPrev='+str(event.ofsPrev)+' doesn\'t match the previous event ('+str(lastOffset)+')')
 			vassert(event.ofsModuleName in self.moduleOffsets, prefix+': ofsModuleName '+str(event.ofsModuleName)+' doesn\'t match any of the known modules')
@@ -214,31 +330,66 @@ class DbVerifier(mirandadb.MirandaDbxMmap):
 			unkflags = event.flags & ~(event.DBEF_SENT | event.DBEF_READ | event.DBEF_RTL | event.DBEF_UTF | event.DBEF_ENCRYPTED)
 			vassert(unkflags == 0, prefix+': Unknown flags: '+str(event.flags))
 			
-			lastOffset = offset
-			offset = event.ofsNext
-		return (eventCount, lastOffset)
+			lastOffset = event.offset
+		return (eventCount, lastOffset, idCounts)
 
-	# Counts the number of events in the chain belonging to a particular ID.
+	# Returns Counter({contactID: event count}) for the meta's chain. The chain is only walked once
+	# for all children (or not at all if the meta has been verified already).
 	# Doesn't do anything else, doesn't increase totalUsed
-	def count_events(self, offset, id):
-		eventCount = 0
-		while offset <> 0:
-			event = self.read_event(offset)
-			if event.contactID == id:
-				eventCount += 1
-			offset = event.ofsNext
-		return eventCount
+	def meta_event_counts(self, meta):
+		idCounts = self.metaEventCounts.get(meta.contactID, None)
+		if idCounts == None:
+			idCounts = Counter(event.contactID for event in self.scan_events(meta.ofsFirstEvent, header_only=True))
+			self.metaEventCounts[meta.contactID] = idCounts
+		return idCounts
+
+# Verifies the contact in a worker process, see DbVerifier.verify_contacts_parallel().
+# Returns (totalUsed, struct offsets, struct sizes, warnings) for the contact.
+def verify_contact_part(db, contact, use_memmap):
+	global _warnings
+	if db.moduleOffsets == None:
+		db.scan_modules()
+	db.init_mem()
+	db.use_memmap = use_memmap
+	_warnings = []
+	try:
+		db.verify_contact(contact)
+		return (db.totalUsed, db.memOffsets, db.memSizes, _warnings)
+	finally:
+		_warnings = None
 
 
 def verify_db(args):
-	verifier = DbVerifier(args.dbname)
+	verifier = DbVerifier(args.dbname, use_mmap=args.mmap)
 	verifier.use_memmap = args.memmap
 	if not args.contact:
-		verifier.verify()
+		verifier.verify(args.jobs)
+		if args.memmap:
+			print_coverage(verifier, verifier.gaps, args.gaps)
 	else:
 		verifier.scan_modules()	# still need this
 		for contact in args.contact:
-			verifier.verify_contact(verifier.contact_by_id(contact))
+			verifier.verify_contact_id(verifier.contact_by_id(contact))
+		if args.memmap:
+			verifier.check_mem()
+
+# Prints how much of the file is referenced by the database structures, and where the rest is
+def print_coverage(db, gaps, list_gaps):
+	fileEnd = db.header.ofsFileEnd
+	unreferenced = sum(size for (offset, size) in gaps)
+	print "Coverage of "+str(fileEnd)+" bytes up to ofsFileEnd:"
+	print "  Referenced: "+str(fileEnd - unreferenced)+" bytes in "+str(len(db.memOffsets))+" structs"
+	print "  Unreferenced: "+str(unreferenced)+" bytes in "+str(len(gaps))+" gaps"
+	print "  SlackSpace: "+str(db.header.slackSpace)+" (unreferenced - slackSpace = "+str(unreferenced - db.header.slackSpace)+")"
+	if db.fileSize <> fileEnd:
+		print "  File size: "+str(db.fileSize)+" ("+str(db.fileSize - fileEnd)+" bytes past ofsFileEnd)"
+	if gaps:
+		largest = sorted(gaps, key=lambda gap: gap[1], reverse=True)[:10]
+		print "  Largest gaps: "+', '.join(str(offset)+'~'+str(size) for (offset, size) in largest)
+	if list_gaps:
+		print "Gaps:"
+		for (offset, size) in gaps:
+			print "  "+str(offset)+'~'+str(size)
 
 
 """
@@ -263,14 +414,18 @@ If any of [Message1, Message2] matches CorruptedMessage module, type and flags,
 This doesn't analyze whether CorruptedMessage is in fact corrupt. Too hard to tell.
 """
 def delete_extra_events(args):
-	db1 = mirandadb.MirandaDbxMmap(args.old_dbname)
-	db2 = mirandadb.MirandaDbxMmap(args.dbname, writeable=args.write)
+	db1 = mirandadb.MirandaDbxMmap(args.old_dbname, use_mmap=args.mmap, use_index=args.index)
+	db2 = mirandadb.MirandaDbxMmap(args.dbname, writeable=args.write, use_mmap=args.mmap, use_index=args.index)
 	contacts1 = mirandadb.select_contacts_opt(db1, args.contact)
 	contacts2 = mirandadb.select_contacts_opt(db2, args.contact)
 	contacts_map = mirdiff.map_contacts(contacts1, contacts2)
-	for (contact1, contact2) in contacts_map.items():
-		if (contact1 == None) or (contact2 == None): continue
-		delete_extra_events_contact(db1, db2, contact1, contact2)
+	with db2.batch():
+		for (contact1, contact2) in contacts_map.items():
+			if (contact1 == None) or (contact2 == None): continue
+			delete_extra_events_contact(db1, db2, contact1, contact2)
+	if args.index:
+		db1.update_index()
+		db2.update_index()
 
 # Compares two contacts event by event
 def delete_extra_events_contact(db1, db2, contact1, contact2):
@@ -309,51 +464,222 @@ def delete_extra_events_contact(db1, db2, contact1, contact2):
 				print "Skipping: "+mirandadb.format_event(db2, e2)
 
 
+"""
+Carves database structures out of the raw file.
+Broken chains leave events (and contacts, settings, modules) in the file which no pointer leads to.
+All structures start with a 0x??DECADE signature, so we scan the file for these and see which of the
+candidates look like valid structures and are not reachable from the header.
+Deleted structures stay in the file too (until their space is reused), so they will also be found.
+"""
+class DbCarver(mirandadb.MirandaDbxMmap):
+	# Little-endian signatures: DE CA DE, then the type byte
+	SIGNATURES = re.compile(r'\xDE\xCA\xDE[\x43\x45\x4D\x53]')
+	CLASSES = {
+		'\x43': mirandadb.DBContact,
+		'\x45': mirandadb.DBEventHeader,
+		'\x4D': mirandadb.DBModuleName,
+		'\x53': mirandadb.DBContactSettings,
+	}
+	
+	# Sizes of the structures on disk (DBContactSettings.size() is only the fixed part)
+	@staticmethod
+	def struct_size(obj):
+		if isinstance(obj, mirandadb.DBContactSettings):
+			return obj.size() + obj.cbBlob
+		return obj.size()
+	
+	# Collects (offset, size) of all structures reachable from the header, sorted by offset
+	def scan_reachable(self):
+		reachable = [(self.header.offset, self.header.size())]
+		for module in self.get_modules():
+			reachable.append((module.offset, module.size()))
+		for contact in [self.user] + self.contacts():
+			reachable.append((contact.offset, contact.size()))
+			for ofsSettings in self.contact_settings_offsets(contact):
+				settings = self.read(mirandadb.DBContactSettings(), ofsSettings)
+				reachable.append((ofsSettings, self.struct_size(settings)))
+			for event in self.scan_events(contact, header_only=True):
+				reachable.append((event.offset, event.size()))
+		reachable.sort()
+		self.reachableOffsets = array('I', (offset for (offset, size) in reachable))
+		self.reachableEnds = array('I', (offset + size for (offset, size) in reachable))
+	
+	def is_reachable(self, offset):
+		i = bisect.bisect_left(self.reachableOffsets, offset)
+		return (i < len(self.reachableOffsets)) and (self.reachableOffsets[i] == offset)
+	
+	# True if the range intersects any reachable structure
+	def overlaps_reachable(self, offset, size):
+		i = bisect.bisect_right(self.reachableOffsets, offset) - 1
+		if (i >= 0) and (self.reachableEnds[i] > offset):
+			return True
+		return (i+1 < len(self.reachableOffsets)) and (self.reachableOffsets[i+1] < offset + size)
+	
+	# Reads the candidate structure at the offset, or returns None if it doesn't look valid
+	def read_candidate(self, cl, offset):
+		fileEnd = self.header.ofsFileEnd
+		try:
+			if cl == mirandadb.DBContactSettings:
+				# Check the blob size before reading (or seeking past) that many bytes
+				header = cl()
+				if self.mm <> None:
+					mirandadb.DBStruct.read_from(header, self.mm, offset)
+				else:
+					self.file.seek(offset, 0)
+					mirandadb.DBStruct.read(header, self.file)
+				if offset + self.struct_size(header) > fileEnd:
+					return None
+			obj = self.read(cl(), offset)
+		except (mirandadb.SignatureError, struct.error, UnicodeDecodeError):
+			return None
+		if offset + self.struct_size(obj) > fileEnd:
+			return None
+		if cl == mirandadb.DBContact:
+			valid = (obj.ofsNext < fileEnd) and (obj.ofsFirstSettings < fileEnd) \
+				and (obj.ofsFirstEvent < fileEnd) and (obj.ofsLastEvent < fileEnd)
+		elif cl == mirandadb.DBEventHeader:
+			valid = (obj.ofsPrev < fileEnd) and (obj.ofsNext < fileEnd) and (obj.timestamp <> 0) \
+				and (self.get_module_name(obj.ofsModuleName) <> None)
+		elif cl == mirandadb.DBModuleName:
+			valid = (obj.ofsNext < fileEnd) and (obj.cbName > 0)
+		else:
+			valid = (obj.ofsNext < fileEnd) and (self.get_module_name(obj.ofsModuleName) <> None)
+		return obj if valid else None
+	
+	# Yields the valid unreachable structures, in file order.
+	# Candidates inside reachable or already found structures are skipped (they're usually
+	# signature-like bytes in blobs), counted in self.skipped.
+	def carve(self):
+		self.scan_reachable()
+		self.skipped = 0
+		buf = self.mm
+		if buf == None:
+			buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		end = 0		# of the last structure found
+		for match in self.SIGNATURES.finditer(buf, 0, self.header.ofsFileEnd):
+			offset = match.start()
+			if self.is_reachable(offset):
+				continue
+			obj = self.read_candidate(self.CLASSES[match.group()[3]], offset)
+			if obj == None:
+				continue
+			size = self.struct_size(obj)
+			if (offset < end) or self.overlaps_reachable(offset, size):
+				self.skipped += 1
+				continue
+			end = offset + size
+			yield obj
+	
+	# Links orphaned events back into the chains of their contacts, by timestamp.
+	# Returns the events which have no contact to go to.
+	def relink_events(self, events):
+		hosts = {}		# host contactID -> [events]
+		homeless = []
+		for event in events:
+			contact = self.contact_by_id(event.contactID)
+			if contact == None:
+				homeless.append(event)
+				continue
+			host = self.get_host_contact(contact)
+			hosts.setdefault(host.contactID, []).append(event)
+		with self.batch():
+			for (hostId, events) in hosts.items():
+				events.sort(key=lambda event: event.timestamp)
+				self.link_events(events, self.contact_by_id(hostId))
+			# Deleted events have been counted as slack, and now they're in use again.
+			# Events lost to a broken chain never were, so don't go below zero.
+			relinked = sum(event.size() for events in hosts.values() for event in events)
+			self.header.slackSpace -= min(relinked, self.header.slackSpace)
+			self.write(self.header, 0)
+		return homeless
+
+def carve(args):
+	if args.relink and not args.write:
+		parser.error('--relink requires --write')
+	db = DbCarver(args.dbname, writeable=args.write, use_mmap=args.mmap)
+	events = []
+	for obj in db.carve():
+		if isinstance(obj, mirandadb.DBEventHeader):
+			events.append(obj)
+			print "Event "+mirandadb.format_event(db, db.read_event(obj.offset))
+		elif isinstance(obj, mirandadb.DBContact):
+			print "Contact "+str(obj.offset)+": #"+str(obj.contactID)+", "+str(obj.eventCount)+" events"
+		elif isinstance(obj, mirandadb.DBContactSettings):
+			print "Settings "+str(obj.offset)+": "+unicode(db.get_module_name(obj.ofsModuleName))+", "+str(obj.cbBlob)+" bytes"
+		else:
+			print "Module "+str(obj.offset)+": "+obj.name
+	log.warning("Unreachable: "+str(len(events))+" events; skipped "+str(db.skipped)+" candidates inside other structures")
+	if args.relink and events:
+		for event in db.relink_events(events):
+			log.warning("Event "+str(event.offset)+": no contact #"+str(event.contactID)+", not relinked")
+
+
 # Main
-parser = argparse.ArgumentParser(description="Analyzes Miranda database for corruption.",
-	parents=[coreutils.argparser()])
-parser.add_argument("dbname", help='path to database file')
-parser.add_argument("--write", help='opens the databases for writing (WARNING: enables editing functions!)', action='store_true')
-subparsers = parser.add_subparsers(title='subcommands')
-
-sparser = subparsers.add_parser('verify', help='verifies database integrity')
-sparser.add_argument('--contact', type=int, nargs='*', help='verify only these contacts')
-sparser.add_argument('--memmap', action='store_true', help='verify that structures have no overlap in memory')
-sparser.set_defaults(func=verify_db)
-
-sparser = subparsers.add_parser('dump-events', formatter_class=coreutils.SmartFormatter,
-	help='prints all events for the given contacts',
-	description="""
-		Analyzes unicode composition of the messages and tries to determine which messages seem corrupted.
-		Highly unscientific, because:
-		  1. What's rare for one language is common in another.
-		  2. Corrupted messages sometimes take any forms, including chunks of unrelated latin texts, so look entirely bening.
-		If you have a non-corrupted version of the database you may be better off with `mirdiff`.
-	""")
-sparser.add_argument('contact', type=str, nargs='*', help='print events for these contacts')
-sparser.add_argument("--bad", help='dumps only bad events', action='store_true')
-sparser.add_argument("--bad-offsets", help='gathers bad event offset statistics', action='store_true')
-sparser.set_defaults(func=dump_events)
-
-sparser = subparsers.add_parser('delete-extra', formatter_class=coreutils.SmartFormatter,
-	help='delete messages which are missing from the older version of the database',
-	description="""
-		Compares the database to its older version and deletes all events that are:
-		  1. Not entirely new (== in the timespan that the databases share)
-		  2. Are missing from the older version of the DB
-		  3. There are messages for the same timespan which **may** be their uncorrupted version.
-		This is commonly used to repair corrupted message bodies:
-		  1. `mirdiff --merge` older database into newer one (bringing clean copies of all corrupted messages)
-		  2. `delete-extra` to remove corrupted copies (as they are not in older DB)
-		Note that this **does not check that messages are in fact corrupted**.
-	""")
-sparser.add_argument('--contact', type=str, nargs='*', help='delete events for these contacts')
-sparser.add_argument('--old-dbname', type=str, required=True, help='use this old db version')
-sparser.add_argument('--print-diff', action='store_true', help='print event differences between versions')
-sparser.set_defaults(func=delete_extra_events)
-
-args = parser.parse_args()
-coreutils.init(args)
+def main():
+	global parser
+	parser = argparse.ArgumentParser(description="Analyzes Miranda database for corruption.",
+		parents=[coreutils.argparser()])
+	parser.add_argument("dbname", help='path to database file')
+	parser.add_argument("--write", help='opens the databases for writing (WARNING: enables editing functions!)', action='store_true')
+	parser.add_argument("--mmap", help='maps the databases into memory and decodes them in place (faster with large databases)', action='store_true')
+	parser.add_argument("--index", help='keeps sidecar indexes next to the databases (dbname.idx) for faster reopening; verify always reads the database itself', action='store_true')
+	subparsers = parser.add_subparsers(title='subcommands')
+
+	sparser = subparsers.add_parser('verify', help='verifies database integrity')
+	sparser.add_argument('--contact', type=int, nargs='*', help='verify only these contacts')
+	sparser.add_argument('--memmap', action='store_true', help='verify that structures have no overlap in memory, and print how much of the file they cover')
+	sparser.add_argument('--gaps', action='store_true', help='with --memmap, list all unreferenced gaps')
+	sparser.add_argument('--jobs', type=int, default=1, help='verify the contacts in this many processes (0: one per CPU)')
+	sparser.set_defaults(func=verify_db)
+
+	sparser = subparsers.add_parser('dump-events', formatter_class=coreutils.SmartFormatter,
+		help='prints all events for the given contacts',
+		description="""
+			Analyzes unicode composition of the messages and tries to determine which messages seem corrupted.
+			Highly unscientific, because:
+			  1. What's rare for one language is common in another.
+			  2. Corrupted messages sometimes take any forms, including chunks of unrelated latin texts, so look entirely bening.
+			If you have a non-corrupted version of the database you may be better off with `mirdiff`.
+		""")
+	sparser.add_argument('contact', type=str, nargs='*', help='print events for these contacts')
+	sparser.add_argument("--bad", help='dumps only bad events', action='store_true')
+	sparser.add_argument("--bad-offsets", help='gathers bad event offset statistics', action='store_true')
+	sparser.add_argument("--jobs", type=int, default=1, help='decode the contacts in this many processes (0: one per CPU)')
+	sparser.set_defaults(func=dump_events)
+
+	sparser = subparsers.add_parser('delete-extra', formatter_class=coreutils.SmartFormatter,
+		help='delete messages which are missing from the older version of the database',
+		description="""
+			Compares the database to its older version and deletes all events that are:
+			  1. Not entirely new (== in the timespan that the databases share)
+			  2. Are missing from the older version of the DB
+			  3. There are messages for the same timespan which **may** be their uncorrupted version.
+			This is commonly used to repair corrupted message bodies:
+			  1. `mirdiff --merge` older database into newer one (bringing clean copies of all corrupted messages)
+			  2. `delete-extra` to remove corrupted copies (as they are not in older DB)
+			Note that this **does not check that messages are in fact corrupted**.
+		""")
+	sparser.add_argument('--contact', type=str, nargs='*', help='delete events for these contacts')
+	sparser.add_argument('--old-dbname', type=str, required=True, help='use this old db version')
+	sparser.add_argument('--print-diff', action='store_true', help='print event differences between versions')
+	sparser.set_defaults(func=delete_extra_events)
+
+	sparser = subparsers.add_parser('carve', formatter_class=coreutils.SmartFormatter,
+		help='scans the file for structures not reachable from the header',
+		description="""
+			Scans the raw file for event, contact, settings and module signatures and prints all valid structures
+			which no chain leads to. These are lost due to broken chains, or deleted.
+			With --relink (and --write) the found events are linked back into the chains of their contacts by timestamp.
+		""")
+	sparser.add_argument('--relink', action='store_true', help='link the found events back into their contacts\' chains')
+	sparser.set_defaults(func=carve)
+
+	global args
+	args = parser.parse_args()
+	coreutils.init(args)
 	
-if args.func <> None:
-	args.func(args)
+	if args.func <> None:
+		args.func(args)
+
+if __name__ == "__main__":
+	sys.exit(main())
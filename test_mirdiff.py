@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Tests for mirdiff. Run: python -m unittest test_mirdiff
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import mirandadb
+import mirdiff
+
+REGION_SIZE = mirdiff.RegionHashes.REGION_SIZE
+
+def pack_setting(name, value):
+	if isinstance(value, (int, long)):
+		return struct.pack('=B', len(name)) + name + struct.pack('=BI', mirandadb.DBSetting.DBVT_DWORD, value)
+	return struct.pack('=B', len(name)) + name + struct.pack('=BH', mirandadb.DBSetting.DBVT_ASCIIZ, len(value)) + value
+
+# Builds a database with a MetaContact (#3) hosting the events of its two children (#1, #2).
+# The chain interleaves the children by timestamp, but stores them apart:
+#   region 0: header, contacts and the events of #2
+#   region 1: the events of #1
+#   region 2 and on: empty, new events go here
+# Returns {contactID: [event offsets in chain order]}
+def build_meta_db(filename, count=50):
+	buf = bytearray(struct.calcsize(mirandadb.DBHeader.FORMAT))
+	def alloc(data):
+		offset = len(buf)
+		buf.extend(data)
+		return offset
+	def put(offset, data):
+		buf[offset:offset+len(data)] = data
+	
+	modules = {}
+	ofsPrevModule = 0
+	for name in ['ICQ', 'JABBER', 'MetaContacts', 'Protocol']:
+		modules[name] = alloc(struct.pack('=IIB', mirandadb.DBModuleName.SIGNATURE, 0, len(name)) + name)
+		if ofsPrevModule <> 0:
+			put(ofsPrevModule + 4, struct.pack('=I', modules[name]))
+		ofsPrevModule = modules[name]
+	
+	contacts = {}
+	def add_contact(contactId, settings):
+		ofsFirstSettings = 0
+		for (module, values) in reversed(settings):
+			blob = ''.join(pack_setting(name, value) for (name, value) in values) + '\0'
+			ofsFirstSettings = alloc(struct.pack('=IIII', mirandadb.DBContactSettings.SIGNATURE,
+				ofsFirstSettings, modules[module], len(blob)) + blob)
+		contacts[contactId] = alloc(struct.pack('=IIIIIIIII', mirandadb.DBContact.SIGNATURE,
+			0, ofsFirstSettings, 0, 0, 0, 0, 0, contactId))
+	add_contact(0, [])
+	add_contact(1, [('Protocol', [('p', 'ICQ')]), ('MetaContacts', [('ParentMeta', 3)])])
+	add_contact(2, [('Protocol', [('p', 'JABBER')]), ('MetaContacts', [('ParentMeta', 3)])])
+	add_contact(3, [('Protocol', [('p', 'MetaContacts')]), ('MetaContacts', [('NumContacts', 2), ('Handle0', 1), ('Handle1', 2)])])
+	for contactId in [1, 2]:
+		put(contacts[contactId] + 4, struct.pack('=I', contacts[contactId + 1]))
+	
+	def add_event(contactId, module, timestamp):
+		blob = 'message from '+str(contactId)+' at '+str(timestamp)+'\0'
+		return alloc(struct.pack('=IIIIIIIHI', mirandadb.DBEventBase.SIGNATURE, contactId, 0, 0,
+			modules[module], timestamp, mirandadb.DBEventBase.DBEF_UTF, 0, len(blob)) + blob)
+	events = {}
+	events[2] = [add_event(2, 'JABBER', 1500000000 + 2*i) for i in range(count)]
+	assert len(buf) < REGION_SIZE
+	buf.extend('\0' * (REGION_SIZE - len(buf)))
+	events[1] = [add_event(1, 'ICQ', 1500000000 + 2*i + 1) for i in range(count)]
+	assert len(buf) < 2*REGION_SIZE
+	slackSpace = 2*REGION_SIZE - len(buf)
+	buf.extend('\0' * slackSpace)
+	
+	chain = [offset for pair in zip(events[2], events[1]) for offset in pair]
+	for (ofsPrev, offset, ofsNext) in zip([0] + chain[:-1], chain, chain[1:] + [0]):
+		put(offset + 8, struct.pack('=II', ofsPrev, ofsNext))
+	put(contacts[1] + 12, struct.pack('=I', count))
+	put(contacts[2] + 12, struct.pack('=I', count))
+	put(contacts[3] + 12, struct.pack('=III', len(chain), chain[0], chain[-1]))
+	put(0, struct.pack(mirandadb.DBHeader.FORMAT, 'Miranda NG DBu\0\x1a', 0x0700, len(buf), slackSpace,
+		len(contacts) - 1, contacts[1], contacts[0], modules['ICQ']))
+	with open(filename, 'wb') as f:
+		f.write(buf)
+	return events
+
+
+class TestEventPrefilter(unittest.TestCase):
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp()
+		self.dbname1 = os.path.join(self.tempdir, 'db1.dat')
+		self.dbname2 = os.path.join(self.tempdir, 'db2.dat')
+		self.events = build_meta_db(self.dbname1)
+		shutil.copyfile(self.dbname1, self.dbname2)
+	
+	def tearDown(self):
+		shutil.rmtree(self.tempdir)
+	
+	def unchanged(self, contactId):
+		db1 = mirandadb.MirandaDbxMmap(self.dbname1)
+		db2 = mirandadb.MirandaDbxMmap(self.dbname2)
+		prefilter = mirdiff.EventPrefilter(db1, db2)
+		return prefilter.unchanged(db1.contact_by_id(contactId), db2.contact_by_id(contactId))
+	
+	def test_same(self):
+		for contactId in [1, 2, 3]:
+			self.assertTrue(self.unchanged(contactId))
+	
+	# Replacing an event of one child with another one at the same timestamp keeps the fingerprint
+	# and the layout. The bytes that change are the links in the other child's events and the new
+	# event past all of the first child's events.
+	def test_replaced_child_event(self):
+		db = mirandadb.MirandaDbxMmap(self.dbname2, writeable=True)
+		old = db.read_event(self.events[1][10])
+		db.delete_event(old.offset)
+		event = mirandadb.DBEvent()
+		event.contactID = old.contactID
+		event.ofsModuleName = old.ofsModuleName
+		event.timestamp = old.timestamp
+		event.flags = old.flags
+		event.eventType = old.eventType
+		event.blob = 'replaced\0'
+		db.add_event(event)
+		self.assertGreaterEqual(event.offset, 2*REGION_SIZE)
+		db.file.close()
+		
+		self.assertFalse(self.unchanged(1))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -2,6 +2,9 @@
 import sys
 import logging
 import argparse
+import bisect
+import re
+from array import array
 
 log = logging.getLogger('utf')
 
@@ -10,6 +13,7 @@ log = logging.getLogger('utf')
 # Returns a pair of bytes:
 #   (string, remainder)
 # The remainder is empty if there's no data left.
+# The buffer may be a str or a read-only buffer() view, e.g. into a mapped file.
 def eatansi(buf):
 	# Most ANSI character sets are single-byte, can't contain \0. Even most MBCS don't support internal \0s.
 	# Some in theory can, but not knowing the encoding, we're fucked. So let's assume they don't.
@@ -17,41 +21,46 @@ def eatansi(buf):
 
 def eatutf8(buf):
 	# No code point in UTF-8 can contain \0, so this is fine:
+	if not isinstance(buf, str):
+		buf = str(buf)		# views have no split()
 	parts = buf.split('\0', 1)
 	if len(parts) < 2:
 		parts.append('')
 	return parts
 
 def eatutf16(buf):
-	# UTF16 string ends with \0\0 but it must come at a 2-byte mark
-	for i in range(0, len(buf) // 2):
-		if (buf[2*i]=='\0') and (buf[2*i+1]=='\0'):
-			if i <= 0:
-				return ('', buf[2:])
-			else:
-				return (buf[0:2*i], buf[2*i+2:])
-	return (buf, '')
+	# UTF16 string ends with \0\0 but it must come at a 2-byte mark, so look for a zero 16-bit unit
+	try:
+		i = utf16units(buf).index(0)
+	except ValueError:
+		return (buf, '')
+	return (buf[0:2*i], buf[2*i+2:])
+
+# Returns UTF16LE bytes as an array of 16-bit units. An odd trailing byte is ignored.
+def utf16units(bytes):
+	units = array('H')
+	units.fromstring(buffer(bytes, 0, len(bytes) // 2 * 2))
+	if sys.byteorder <> 'little':
+		units.byteswap()
+	return units
 
 
 # Converts u'' utf16 string (a sequence of 2-byte characters), splitting each character into 2 bytes
 def utf16bytes(str):
-	ret = ""
-	for ch in str:
-		ch = ord(ch)
-		ret += (chr(ch & 0xFF) + chr(ch >> 8))
-	return ret
+	# Python 2 encodes lone surrogates as they are, so this is a plain 1:1 conversion of 16-bit units
+	return str.encode('UTF-16LE')
 
+# Converts bytes to a u'' string of 16-bit units, same as utf16test() expects:
+# surrogates are not paired up or validated.
 def bytesutf16(bytes):
-	ret = ""
-	i = 0
-	while i < len(bytes) // 2:
-		ch1 = bytes[2*i+0]
-		ch2 = bytes[2*i+1]
-		i += 1
-		ret += unichr((ord(ch2) << 8) + ord(ch1))
 	if len(bytes) % 2 <> 0:
 		log.warning('Odd-length utf16 hex string!')
-	return ret
+	units = utf16units(bytes)
+	if array('u').itemsize <> units.itemsize:	# wide Python build, widen the units
+		units = array('I', units)
+	ret = array('u')
+	ret.fromstring(units.tostring())
+	return ret.tounicode()
 
 
 # Verifies that the data looks like valid UTF8 and not junk
@@ -111,8 +120,15 @@ def utf8test(data):
 # Verifies that the data looks like valid UTF16 and not junk
 # Returns True or a problem description
 def utf16test(data):
-	i = 0
+	if not isinstance(data, unicode):
+		data = data.decode('latin-1')	# bytes as they are
 	stats = CharStats()
+	if _surrogate.search(data) == None:
+		# Nothing to pair up, score all characters at once
+		stats.test_chars(codepoints(data))
+		return stats.summarize()
+	i = 0
+	chars = []
 	while i < len(data):
 		ch = ord(data[i])
 		i += 1
@@ -128,11 +144,51 @@ def utf16test(data):
 			#SURROGATE_OFFSET = 0x10000 - (0xD800 << 10) - 0xDC00
 			#codepoint = (ch << 10) + ch2 + SURROGATE_OFFSET
 			codepoint = 0x10000 + ((ch - 0xD800) << 10) + (ch2 - 0xDC00)
-			stats.test_char(codepoint)
+			chars.append(codepoint)
 			continue
-		stats.test_char(ch)
+		chars.append(ch)
+	stats.test_chars(chars)
 	return stats.summarize()
 
+_surrogate = re.compile(u'[\ud800-\udfff]')
+
+# Same as utf16test() for a number of texts, e.g. all messages of a contact. Returns a list of verdicts.
+# All distinct characters of the texts are classified at once, then each text is translated
+# to the classes of its characters (normal ones dropped) and those are counted.
+def utf16test_all(texts):
+	texts = [text if isinstance(text, unicode) else text.decode('latin-1') for text in texts]	# bytes as they are
+	verdicts = [None] * len(texts)
+	distinct = set()
+	for (n, text) in enumerate(texts):
+		if _surrogate.search(text) <> None:
+			verdicts[n] = utf16test(text)	# needs pairing up, rare
+			continue
+		distinct.update(text)
+	table = {}
+	for ch in distinct:
+		i = bisect.bisect_right(CharStats.bounds, ord(ch))
+		val = CharStats.classes[i] if i < len(CharStats.classes) else 5
+		table[ord(ch)] = unicode(val) if val <> 0 else None
+	for (n, text) in enumerate(texts):
+		if verdicts[n] <> None:
+			continue
+		classes = text.translate(table)
+		stats = CharStats()
+		stats.total = len(text)
+		stats.uncommon = classes.count(u'1')
+		stats.rare = classes.count(u'2')
+		if len(classes) > stats.uncommon + stats.rare:
+			stats.list_weird(codepoints(text))
+		verdicts[n] = stats.summarize()
+	return verdicts
+
+# Returns the characters of a u'' string as an array of ints
+def codepoints(text):
+	chars = array('u', text)
+	ret = array('I' if chars.itemsize == array('I').itemsize else 'H')
+	ret.fromstring(chars.tostring())
+	return ret
+
 
 # Analyzes characters (Unicode 32 bit codepoints) and tries to estimate the likelihood
 # that this is a valid unicode string and not junk
@@ -184,28 +240,58 @@ class CharStats:
 		(0x2fa1f, 2),		# Very rare CJK
 		(0xfffff, 5),		# Private use or invalid
 	]
+	# The blocks are matched first to last, so an entry not above all the preceding ones never matches.
+	# Without those, the bounds are sorted and can be bisected:
+	#   character ch belongs to classes[bisect_right(bounds, ch)], or is weird if that's past the end.
+	bounds = []
+	classes = []
+	for (bound, val) in blocks:
+		if (len(bounds) <= 0) or (bound > bounds[-1]):
+			bounds.append(bound)
+			classes.append(val)
+	del bound, val
 
 	# Incorporates unicode character (int32) into statistics
 	def test_char(self, ch):
 		self.total += 1
-		found = False
-		#log.warning('eh')
-		for key in self.blocks:
-			#log.warning(key)
-			if ch < key[0]:
-				val = key[1]
-				if val == 0:
-					pass
-				elif val == 1:
-					self.uncommon += 1
-				elif val == 2:
-					self.rare += 1
-				else:
-					self.weird_list.append(hex(ch))
-				found = True
-				break
-		if not found:
+		i = bisect.bisect_right(self.bounds, ch)
+		val = self.classes[i] if i < len(self.classes) else 5
+		if val == 0:
+			pass
+		elif val == 1:
+			self.uncommon += 1
+		elif val == 2:
+			self.rare += 1
+		else:
 			self.weird_list.append(hex(ch))
+
+	# Incorporates a number of characters (ints) at once: sorts them, then counts each block's share by bisection
+	def test_chars(self, chars):
+		ordered = sorted(chars)
+		self.total += len(ordered)
+		weird = False
+		start = 0
+		for i in xrange(len(self.bounds)+1):
+			end = bisect.bisect_left(ordered, self.bounds[i], start) if i < len(self.bounds) else len(ordered)
+			if end > start:
+				val = self.classes[i] if i < len(self.classes) else 5
+				if val == 1:
+					self.uncommon += end - start
+				elif val == 2:
+					self.rare += end - start
+				elif val <> 0:
+					weird = True
+			start = end
+		if weird:
+			self.list_weird(chars)
+
+	# Adds the weird characters to weird_list, in their original order
+	def list_weird(self, chars):
+		last = self.bounds[-1]
+		for ch in chars:
+			i = bisect.bisect_right(self.bounds, ch)
+			if (ch >= last) or (self.classes[i] not in (0, 1, 2)):
+				self.weird_list.append(hex(int(ch)))	# array('I') items are longs
 		
 		
 		"""